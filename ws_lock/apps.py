@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class WsLockConfig(AppConfig):
     name = 'ws_lock'
+
+    def ready(self):
+        from . import signals  # noqa: F401
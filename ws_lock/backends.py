@@ -0,0 +1,603 @@
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+from functools import lru_cache
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from .batching import GroupCommitWriter
+from .cache import item_type_cache, visibility_cache
+from .hashring import HashRing
+from .leases import lease_expiry
+from .models import ItemLock
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def get_lock_backend(path):
+    """Process-wide lock backend instance for the given dotted path"""
+    return import_string(path)()
+
+
+class BaseLockBackend:
+
+    async def start(self):
+        """Called by every accepted connection, on the running event loop"""
+
+    async def acquire_locks(self, user, items):
+        """
+        Lock given items for user, return created locks and active locks the user
+        already had on them (eg: from an earlier connection), so that they can be released
+        """
+        raise NotImplementedError
+
+    async def release_locks(self, user, items):
+        """Unlock given items of user, return released locks"""
+        raise NotImplementedError
+
+    async def leave_locks(self, user):
+        """Unlock every item of user, return released locks"""
+        raise NotImplementedError
+
+    async def change_locks(self, user, added, removed):
+        """Release then acquire locks for user, return acquired and released locks"""
+        left_locks = await self.release_locks(user, removed) if removed else []
+        active_locks = await self.acquire_locks(user, added) if added else []
+        return active_locks, left_locks
+
+    async def release_locks_many(self, changes):
+        """Unlock given items of every (user, items) at once, return released locks by user id"""
+        return {user.id: await self.release_locks(user, items) for user, items in changes}
+
+
+class ORMLockBackend(BaseLockBackend):
+    """Every acquisition and release goes straight to the database"""
+
+    async def acquire_locks(self, user, items):
+        @sync_to_async
+        def _inner():
+            # validate items by filtering with user-group-permission
+            visible_types = visibility_cache.visible_types(user)
+            validated_items = [
+                item_id
+                for item_id, item_type in item_type_cache.item_types(items).items()
+                if item_type in visible_types
+            ]
+            # items already locked are skipped by the database
+            locks = ItemLock.objects.acquire(user, validated_items, expires=lease_expiry())
+            conflicting = set(validated_items).difference(lock.item_id for lock in locks)
+            if conflicting:
+                locks.extend(ItemLock.objects.filter(locked=True, user=user, item_id__in=conflicting))
+                locks.sort(key=lambda lock: lock.item_id)
+            return locks
+
+        return await _inner()
+
+    async def release_locks(self, user, items):
+        return await user.lock_items.filter(item_id__in=items).arelease()
+
+    async def leave_locks(self, user):
+        return await user.lock_items.arelease()
+
+    # users released by a single statement, SQLite limits the depth of the OR expression
+    release_batch_size = 500
+
+    async def release_locks_many(self, changes):
+        left_locks = {user.id: [] for user, _items in changes}
+        for start in range(0, len(changes), self.release_batch_size):
+            released_filter = Q()
+            for user, items in changes[start:start + self.release_batch_size]:
+                released_filter |= Q(user_id=user.id, item_id__in=items)
+            for lock in await ItemLock.objects.filter(released_filter).arelease():
+                left_locks[lock.user_id].append(lock)
+        return left_locks
+
+
+class GroupCommitLockBackend(ORMLockBackend):
+    """
+    Lock changes of every consumer of the worker are collected for a few
+    milliseconds and written together in a single transaction,
+    see ws_lock.batching.GroupCommitWriter.
+    """
+
+    def __init__(self):
+        self.writer = GroupCommitWriter()
+
+    async def acquire_locks(self, user, items):
+        active_locks, _left_locks = await self.change_locks(user, items, [])
+        return active_locks
+
+    async def release_locks(self, user, items):
+        _active_locks, left_locks = await self.change_locks(user, [], items)
+        return left_locks
+
+    async def change_locks(self, user, added, removed):
+        return await self.writer.submit((user, added, removed))
+
+
+class WriteBehindLockBackend(BaseLockBackend):
+    """
+    Base of backends which keep live locks outside of the database: changes are
+    queued with `_write_behind` and written to ItemLock rows in batches.
+    """
+    flush_interval = 0.05
+    flush_batch_size = 500
+
+    def __init__(self):
+        # pending ('acquire'|'release', ItemLock) operations, in order
+        self.pending = []
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    async def _validate(self, user, items):
+        visible = await visibility_cache.avisible_types(user)
+        item_types = await item_type_cache.aitem_types(items)
+        return [i for i in items if item_types.get(i) in visible]
+
+    def _make_lock(self, user, item_id):
+        now = timezone.now()
+        return ItemLock(
+            item_id=item_id,
+            user=user,
+            created=now,
+            updated=now,
+        )
+
+    def _released_locks(self, user, item_ids):
+        now = timezone.now()
+        return [ItemLock(item_id=int(item_id), user=user, locked=False, updated=now) for item_id in item_ids]
+
+    def _write_behind(self, kind, locks):
+        self.pending.extend((kind, lock) for lock in locks)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self.pending:
+            return
+        if self._flush_task is None or self._flush_task.done():
+            delay = 0 if len(self.pending) >= self.flush_batch_size else self.flush_interval
+            self._flush_task = asyncio.get_running_loop().create_task(self._delayed_flush(delay))
+
+    async def _delayed_flush(self, delay):
+        await asyncio.sleep(delay)
+        # operations queued while writing are written by the next round
+        while self.pending:
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception('Writing %d lock changes failed, retrying', len(self.pending))
+                await asyncio.sleep(self.flush_interval)
+
+    async def flush(self):
+        """Write pending operations to database, keeping them queued on failure"""
+        async with self._flush_lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            try:
+                await sync_to_async(self._write)(pending)
+            except BaseException:
+                self.pending[:0] = pending
+                raise
+
+    @staticmethod
+    def _write(pending):
+        # consecutive operations of the same kind are written with a single query
+        runs = []
+        for kind, lock in pending:
+            if runs and runs[-1][0] == kind:
+                runs[-1][1].append(lock)
+            else:
+                runs.append((kind, [lock]))
+
+        with transaction.atomic():
+            for kind, locks in runs:
+                if kind == 'acquire':
+                    # an active lock left behind by another process must not abort the batch
+                    ItemLock.objects.bulk_create(locks, ignore_conflicts=True)
+                    continue
+                # updated is the time of release, as used by compact_locks
+                by_user = {}
+                for lock in locks:
+                    by_user.setdefault(lock.user_id, []).append(lock.item_id)
+                now = timezone.now()
+                for user_id, item_ids in by_user.items():
+                    ItemLock.objects.filter(
+                        locked=True, user_id=user_id, item_id__in=item_ids
+                    ).update(locked=False, updated=now)
+
+
+class MemoryLockBackend(WriteBehindLockBackend):
+    """
+    Lock table kept in process memory, which is authoritative for acquisition
+    and release: changes are written behind to ItemLock rows in batches.
+
+    Only suitable when a single process serves every lock socket, so locks
+    never get a lease.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # item_id -> active ItemLock (not necessarily saved yet)
+        self.locks = {}
+        self._loaded = False
+
+    async def _load(self):
+        if self._loaded:
+            return
+        async for lock in ItemLock.objects.filter(locked=True):
+            self.locks[lock.item_id] = lock
+        self._loaded = True
+
+    def _release(self, lock):
+        del self.locks[lock.item_id]
+        lock.locked = False
+        lock.updated = timezone.now()
+
+    async def acquire_locks(self, user, items):
+        await self._load()
+        acquired = []
+        created = []
+        for item_id in await self._validate(user, items):
+            lock = self.locks.get(item_id)
+            if lock is None:
+                lock = self.locks[item_id] = self._make_lock(user, item_id)
+                created.append(lock)
+            elif lock.user_id != user.id:
+                continue
+            acquired.append(lock)
+        self._write_behind('acquire', created)
+        return acquired
+
+    async def release_locks(self, user, items):
+        await self._load()
+        left_locks = []
+        for item_id in items:
+            lock = self.locks.get(item_id)
+            if lock is not None and lock.user_id == user.id:
+                self._release(lock)
+                left_locks.append(lock)
+        self._write_behind('release', left_locks)
+        return left_locks
+
+    async def leave_locks(self, user):
+        await self._load()
+        user_locks = [lock for lock in self.locks.values() if lock.user_id == user.id]
+        for lock in user_locks:
+            self._release(lock)
+        self._write_behind('release', user_locks)
+        return user_locks
+
+
+class RedisLockBackend(WriteBehindLockBackend):
+    """
+    Live locks are kept in Redis, shared by every process: a hash of item id to
+    user id and a set of item ids for each user. Changes of a message are
+    applied atomically by a server-side script, then written behind to ItemLock
+    rows in batches. Locks never get a lease.
+
+    Settings: WS_LOCK_REDIS_URL (default redis://localhost:6379/0) and
+    WS_LOCK_REDIS_PREFIX (default ws_lock).
+    """
+
+    # KEYS: locks hash, user set; ARGV: user id, number of released items, released items, acquired items
+    # returns acquired items, released items and requested items the user already held
+    CHANGE_SCRIPT = """
+local user, count = ARGV[1], tonumber(ARGV[2])
+local released, acquired, held = {}, {}, {}
+for i = 3, count + 2 do
+    if redis.call('HGET', KEYS[1], ARGV[i]) == user then
+        redis.call('HDEL', KEYS[1], ARGV[i])
+        redis.call('SREM', KEYS[2], ARGV[i])
+        table.insert(released, ARGV[i])
+    end
+end
+for i = count + 3, #ARGV do
+    if redis.call('HSETNX', KEYS[1], ARGV[i], user) == 1 then
+        redis.call('SADD', KEYS[2], ARGV[i])
+        table.insert(acquired, ARGV[i])
+    elseif redis.call('HGET', KEYS[1], ARGV[i]) == user then
+        table.insert(held, ARGV[i])
+    end
+end
+return {acquired, released, held}
+"""
+    # KEYS: locks hash, user set; ARGV: user id
+    LEAVE_SCRIPT = """
+local released = {}
+for _, item in ipairs(redis.call('SMEMBERS', KEYS[2])) do
+    if redis.call('HGET', KEYS[1], item) == ARGV[1] then
+        redis.call('HDEL', KEYS[1], item)
+        table.insert(released, item)
+    end
+end
+redis.call('DEL', KEYS[2])
+return released
+"""
+
+    def __init__(self, client=None):
+        super().__init__()
+        self._client = client
+        self._client_loop = None
+        self._scripts = None
+        # keys share a hash tag so that scripts work on Redis Cluster
+        self.prefix = '{%s}' % getattr(settings, 'WS_LOCK_REDIS_PREFIX', 'ws_lock')
+
+    @property
+    def client(self):
+        # connections of redis.asyncio are bound to the event loop which opened them
+        loop = asyncio.get_running_loop()
+        if self._client is None or (self._client_loop is not None and self._client_loop is not loop):
+            from redis.asyncio import Redis
+
+            self._client = Redis.from_url(getattr(settings, 'WS_LOCK_REDIS_URL', 'redis://localhost:6379/0'))
+            self._client_loop = loop
+            self._scripts = None
+        if self._scripts is None:
+            # run with EVALSHA, scripts are only sent again when missing from the server
+            self._scripts = (
+                self._client.register_script(self.CHANGE_SCRIPT),
+                self._client.register_script(self.LEAVE_SCRIPT),
+            )
+        return self._client
+
+    def _keys(self, user_id):
+        return [f'{self.prefix}:locks', f'{self.prefix}:user:{user_id}']
+
+    async def clear(self):
+        """Remove every lock from Redis"""
+        keys = [key async for key in self.client.scan_iter(match=f'{self.prefix}:*')]
+        if keys:
+            await self.client.delete(*keys)
+
+    async def change_locks(self, user, added, removed):
+        added = await self._validate(user, added) if added else []
+        if not added and not removed:
+            return [], []
+        client = self.client
+        change_script, _leave_script = self._scripts
+        acquired, released, held = await change_script(
+            keys=self._keys(user.id), args=[user.id, len(removed), *removed, *added], client=client
+        )
+        active_locks = [self._make_lock(user, int(item_id)) for item_id in acquired]
+        left_locks = self._released_locks(user, released)
+        self._write_behind('release', left_locks)
+        self._write_behind('acquire', active_locks)
+        # locks already held are returned, not written again
+        active_locks.extend(self._make_lock(user, int(item_id)) for item_id in held)
+        active_locks.sort(key=lambda lock: lock.item_id)
+        return active_locks, left_locks
+
+    async def acquire_locks(self, user, items):
+        active_locks, _left_locks = await self.change_locks(user, items, [])
+        return active_locks
+
+    async def release_locks(self, user, items):
+        _active_locks, left_locks = await self.change_locks(user, [], items)
+        return left_locks
+
+    async def leave_locks(self, user):
+        client = self.client
+        _change_script, leave_script = self._scripts
+        released = await leave_script(keys=self._keys(user.id), args=[user.id], client=client)
+        left_locks = self._released_locks(user, sorted(int(item_id) for item_id in released))
+        self._write_behind('release', left_locks)
+        return left_locks
+
+
+class ShardedLockBackend(WriteBehindLockBackend):
+    """
+    Items are consistent-hashed to WS_LOCK_SHARDS shards (default 1), each one
+    owned by a single worker which keeps the locks of its items in memory and
+    applies changes to them one at a time. Changes of items owned by another
+    worker are forwarded to it over the channel layer, which must then be shared
+    by every worker (eg: channels_redis). Each owner writes its locks behind to
+    ItemLock rows. Locks never get a lease.
+
+    WS_LOCK_OWNED_SHARDS lists the shards owned by the worker (default all of them),
+    every shard must be owned by exactly one running worker.
+    """
+    # seconds to wait for the owner of a shard, acquisitions of the change are then undone
+    timeout = 5
+    # number of changes forwarded to this worker which can still be undone
+    undo_size = 1000
+
+    def __init__(self, shards=None, owned=None, channel_layer=None):
+        super().__init__()
+        self.shards = shards or getattr(settings, 'WS_LOCK_SHARDS', 1)
+        if owned is None:
+            owned = getattr(settings, 'WS_LOCK_OWNED_SHARDS', range(self.shards))
+        self.owned = set(owned)
+        self.ring = HashRing(range(self.shards))
+        self._channel_layer = channel_layer
+        # item_id -> user_id, and user_id -> item ids, of items of owned shards
+        self.locks = {}
+        self.user_items = {}
+        self._loaded = False
+        # request id -> future of the reply of another worker
+        self._waiting = {}
+        self._ids = itertools.count()
+        self._tasks = []
+        self.reply_channel = None
+        # request id -> (user_id, acquired item ids) of changes forwarded to this worker
+        self._applied = OrderedDict()
+
+    @property
+    def channel_layer(self):
+        if self._channel_layer is None:
+            self._channel_layer = get_channel_layer()
+        return self._channel_layer
+
+    @staticmethod
+    def shard_channel(shard):
+        return f'ws_lock.shard.{shard}'
+
+    def shard(self, item_id):
+        return self.ring.node(item_id)
+
+    async def start(self):
+        """
+        Serve owned shards and receive replies, on the running event loop: the
+        first connection of the worker starts serving, so that changes forwarded
+        by other workers are answered before any local one
+        """
+        loop = asyncio.get_running_loop()
+        if self._tasks and self._tasks[0].get_loop() is loop and not self._tasks[0].done():
+            return
+        for task in self._tasks:
+            task.cancel()
+        await self._load()
+        self.reply_channel = await self.channel_layer.new_channel('ws_lock.reply.')
+        self._tasks = [loop.create_task(self._receive_replies())] + [
+            loop.create_task(self._serve(shard)) for shard in sorted(self.owned)
+        ]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def _load(self):
+        if self._loaded:
+            return
+        async for item_id, user_id in ItemLock.objects.filter(locked=True).values_list('item_id', 'user_id'):
+            if self.shard(item_id) in self.owned:
+                self.locks[item_id] = user_id
+                self.user_items.setdefault(user_id, set()).add(item_id)
+        self._loaded = True
+
+    def _apply(self, user_id, added, removed, leave=False):
+        """
+        Change locks of owned items, return acquired and released item ids, and
+        the added ones the user already held
+        """
+        held = self.user_items.setdefault(user_id, set())
+        if leave:
+            removed = sorted(held)
+        released = [item_id for item_id in removed if item_id in held]
+        kept = [item_id for item_id in added if item_id in held and item_id not in released]
+        acquired = [item_id for item_id in added if item_id not in self.locks]
+        now = timezone.now()
+        for item_id in released:
+            del self.locks[item_id]
+            held.discard(item_id)
+        for item_id in acquired:
+            self.locks[item_id] = user_id
+            held.add(item_id)
+        if not held:
+            del self.user_items[user_id]
+        self._write_behind('release', [
+            ItemLock(item_id=item_id, user_id=user_id, locked=False, updated=now) for item_id in released
+        ])
+        self._write_behind('acquire', [
+            ItemLock(item_id=item_id, user_id=user_id, created=now, updated=now) for item_id in acquired
+        ])
+        return acquired, released, kept
+
+    def _undo(self, request_id):
+        """Revert a forwarded change whose reply came too late, see _forward"""
+        applied = self._applied.pop(request_id, None)
+        if applied is None:
+            return
+        user_id, acquired = applied
+        # late releases stand: the user may be gone, and locks never expire
+        self._apply(user_id, [], acquired)
+
+    async def _handle(self, message):
+        if message['type'] == 'lock.undo':
+            self._undo(message['id'])
+            return
+        acquired, released, kept = self._apply(
+            message['user'], message['added'], message['removed'], message['leave']
+        )
+        # locks the user already held are not undone
+        self._applied[message['id']] = (message['user'], acquired)
+        if len(self._applied) > self.undo_size:
+            self._applied.popitem(last=False)
+        await self.channel_layer.send(message['reply'], {
+            'type': 'lock.changed', 'id': message['id'], 'acquired': acquired + kept, 'released': released,
+        })
+
+    async def _serve(self, shard):
+        while True:
+            message = await self.channel_layer.receive(self.shard_channel(shard))
+            try:
+                await self._handle(message)
+            except Exception:
+                # one bad message must not stop the shard
+                logger.exception('Lock shard %s failed to handle %s', shard, message.get('type'))
+
+    async def _receive_replies(self):
+        while True:
+            message = await self.channel_layer.receive(self.reply_channel)
+            future = self._waiting.pop(message['id'], None)
+            if future is not None and not future.done():
+                future.set_result((message['acquired'], message['released']))
+
+    async def _forward(self, shard, user_id, added, removed, leave):
+        request_id = f'{self.reply_channel}-{next(self._ids)}'
+        future = self._waiting[request_id] = asyncio.get_running_loop().create_future()
+        await self.channel_layer.send(self.shard_channel(shard), {
+            'type': 'lock.change', 'id': request_id, 'reply': self.reply_channel,
+            'user': user_id, 'added': added, 'removed': removed, 'leave': leave,
+        })
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._waiting.pop(request_id, None)
+            # the owner may still apply the change, its acquisitions are then reverted while
+            # releases, applied in order by the owner, are reported as done
+            logger.warning('Owner of lock shard %s did not answer, undoing its acquisitions', shard)
+            await self.channel_layer.send(self.shard_channel(shard), {'type': 'lock.undo', 'id': request_id})
+            return [], list(removed)
+
+    async def _change(self, user, added, removed, leave=False):
+        await self.start()
+        by_shard = {shard: ([], []) for shard in (range(self.shards) if leave else ())}
+        for item_id in added:
+            by_shard.setdefault(self.shard(item_id), ([], []))[0].append(item_id)
+        for item_id in removed:
+            by_shard.setdefault(self.shard(item_id), ([], []))[1].append(item_id)
+
+        acquired, released = [], []
+        forwarded = []
+        for shard, (shard_added, shard_removed) in by_shard.items():
+            if shard in self.owned:
+                shard_acquired, shard_released, shard_kept = self._apply(
+                    user.id, shard_added, shard_removed, leave
+                )
+                acquired.extend(shard_acquired + shard_kept)
+                released.extend(shard_released)
+            else:
+                forwarded.append(self._forward(shard, user.id, shard_added, shard_removed, leave))
+        for shard_acquired, shard_released in await asyncio.gather(*forwarded):
+            acquired.extend(shard_acquired)
+            released.extend(shard_released)
+        return (
+            [self._make_lock(user, item_id) for item_id in sorted(acquired)],
+            self._released_locks(user, sorted(released)),
+        )
+
+    async def change_locks(self, user, added, removed):
+        added = await self._validate(user, added) if added else []
+        if not added and not removed:
+            return [], []
+        return await self._change(user, added, removed)
+
+    async def acquire_locks(self, user, items):
+        active_locks, _left_locks = await self.change_locks(user, items, [])
+        return active_locks
+
+    async def release_locks(self, user, items):
+        _active_locks, left_locks = await self.change_locks(user, [], items)
+        return left_locks
+
+    async def leave_locks(self, user):
+        _active_locks, left_locks = await self._change(user, [], [], leave=True)
+        return left_locks
@@ -0,0 +1,149 @@
+import asyncio
+from functools import lru_cache
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from .cache import item_type_cache, visibility_cache
+from .events import broadcast_locks
+from .leases import lease_expiry
+from .models import ItemLock
+
+
+class Batcher:
+    """
+    Collect requests submitted within `window` seconds and handle them
+    together with `process`, which returns a result for every request.
+    """
+    window = 0.02
+
+    def __init__(self):
+        self.pending = []
+        self._task = None
+
+    async def submit(self, request):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((request, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._flush())
+        return await future
+
+    async def _flush(self):
+        batch = []
+        try:
+            # requests submitted while a batch is processed go into the next one
+            while self.pending:
+                await asyncio.sleep(self.window)
+                batch, self.pending = self.pending, []
+                try:
+                    results = await self.process([request for request, _future in batch])
+                except Exception as exc:
+                    for _request, future in batch:
+                        if not future.done():
+                            future.set_exception(exc)
+                else:
+                    for (_request, future), result in zip(batch, results):
+                        if not future.done():
+                            future.set_result(result)
+        except BaseException:
+            # eg: cancelled, submitters must not wait forever
+            pending, self.pending = batch + self.pending, []
+            for _request, future in pending:
+                if not future.done():
+                    future.cancel()
+            raise
+
+    async def process(self, requests):
+        raise NotImplementedError
+
+
+class ReleaseCoordinator(Batcher):
+    """
+    Release locks of users disconnecting at about the same time with a single
+    query and broadcast them with one message per item type.
+    """
+
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.window = getattr(settings, 'WS_LOCK_RELEASE_WINDOW', self.window)
+
+    async def release_locks(self, user, items):
+        """Release and broadcast given items of user, return released locks"""
+        return await self.submit((user, set(items)))
+
+    async def process(self, requests):
+        # connections of the same user may disconnect together
+        changes = {}
+        for user, items in requests:
+            changes.setdefault(user.id, (user, set()))[1].update(items)
+        left_locks = await self.backend.release_locks_many(
+            [(user, sorted(items)) for user, items in changes.values() if items]
+        )
+        await broadcast_locks(get_channel_layer(), [lock for locks in left_locks.values() for lock in locks])
+        return [
+            [lock for lock in left_locks.get(user.id, []) if lock.item_id in items]
+            for user, items in requests
+        ]
+
+
+class GroupCommitWriter(Batcher):
+    """
+    Apply (user, added, removed) lock changes of many consumers in a single
+    transaction, returning (acquired, released) locks to each of them, acquired
+    ones including active locks the user already had.
+
+    Conflicts are resolved deterministically: every release of the batch is
+    applied before any acquisition, and an item requested by more than one
+    change goes to the first submitted one.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.window = getattr(settings, 'WS_LOCK_GROUP_COMMIT_WINDOW', 0.005)
+
+    async def process(self, changes):
+        return await sync_to_async(self._apply)(changes)
+
+    @staticmethod
+    def _apply(changes):
+        released_filter = Q()
+        for user, _added, removed in changes:
+            if removed:
+                released_filter |= Q(user_id=user.id, item_id__in=removed)
+
+        requested = []
+        claimed = set()
+        for user, added, _removed in changes:
+            if not added:
+                continue
+            visible_types = visibility_cache.visible_types(user)
+            item_types = item_type_cache.item_types(added)
+            for item_id in added:
+                if item_id not in claimed and item_types.get(item_id) in visible_types:
+                    claimed.add(item_id)
+                    requested.append((user, item_id))
+
+        with transaction.atomic():
+            released = ItemLock.objects.filter(released_filter).release() if released_filter else []
+            acquired = ItemLock.objects.acquire_many(requested, expires=lease_expiry()) if requested else []
+            # active locks of conflicting items go to the change of the user who already has them
+            conflicting = {item_id for _user, item_id in requested}.difference(lock.item_id for lock in acquired)
+            if conflicting:
+                acquired.extend(ItemLock.objects.filter(locked=True, item_id__in=conflicting))
+
+        released = {(lock.user_id, lock.item_id): lock for lock in released}
+        acquired = {(lock.user_id, lock.item_id): lock for lock in acquired}
+        results = []
+        for user, added, removed in changes:
+            results.append((
+                [acquired.pop((user.id, item_id)) for item_id in added if (user.id, item_id) in acquired],
+                [released.pop((user.id, item_id)) for item_id in removed if (user.id, item_id) in released],
+            ))
+        return results
+
+
+@lru_cache(maxsize=None)
+def get_release_coordinator(backend):
+    return ReleaseCoordinator(backend)
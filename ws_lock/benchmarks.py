@@ -0,0 +1,93 @@
+"""Helpers shared by the benchmark management commands"""
+import os
+import statistics
+import tempfile
+import time
+from contextlib import contextmanager
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import connections
+from .models import Item, ItemLock, ItemTypes, GroupTypeVisibility
+
+User = get_user_model()
+
+
+@contextmanager
+def benchmark_database(verbosity=0, shared=False):
+    """
+    Run a benchmark against a throwaway test copy of the default database,
+    `shared` with other processes (SQLite test databases are in memory otherwise)
+    """
+    connection = connections['default']
+    old_name = connection.settings_dict['NAME']
+    if shared and connection.vendor == 'sqlite':
+        connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'benchmark.sqlite3')
+    connection.creation.create_test_db(verbosity=verbosity, autoclobber=True, serialize=False)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=verbosity)
+
+
+def seed(users, items):
+    """Create users which can see every item type and items of every type"""
+    group = Group.objects.create(name='benchmark')
+    GroupTypeVisibility.objects.bulk_create(
+        [GroupTypeVisibility(group=group, item_type=t) for t in ItemTypes.values]
+    )
+    created_users = User.objects.bulk_create(
+        [User(username=f'bench-{n}') for n in range(users)]
+    )
+    group.user_set.add(*created_users)
+    types = ItemTypes.values
+    Item.objects.bulk_create(
+        [Item(item_type=types[n % len(types)]) for n in range(items)],
+        batch_size=10000,
+    )
+    return (
+        list(User.objects.filter(username__startswith='bench-').order_by('id')),
+        list(Item.objects.order_by('id').values_list('id', flat=True)),
+    )
+
+
+def seed_locks(users, items, history=10, active=0.1, batch_size=10000):
+    """
+    Create `history` released locks for every item and an active lock on
+    a fraction of them, as left by a long running installation.
+    """
+    locks = []
+    for n, item_id in enumerate(items):
+        for h in range(history):
+            locks.append(ItemLock(item_id=item_id, user=users[(n + h) % len(users)], locked=False))
+        if n < len(items) * active:
+            locks.append(ItemLock(item_id=item_id, user=users[n % len(users)]))
+        if len(locks) >= batch_size:
+            ItemLock.objects.bulk_create(locks)
+            locks = []
+    ItemLock.objects.bulk_create(locks)
+
+
+class Timer:
+    """Collect samples of elapsed time, in seconds"""
+
+    def __init__(self):
+        self.samples = []
+
+    @contextmanager
+    def __call__(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.append(time.perf_counter() - start)
+
+    def summary(self):
+        if not self.samples:
+            return 'no samples'
+        ordered = sorted(self.samples)
+        p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        return (
+            f'n={len(ordered)} total={sum(ordered) * 1000:.1f}ms '
+            f'mean={statistics.mean(ordered) * 1000:.3f}ms '
+            f'p50={statistics.median(ordered) * 1000:.3f}ms p99={p99 * 1000:.3f}ms'
+        )
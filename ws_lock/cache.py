@@ -0,0 +1,298 @@
+"""Process-wide caches of rarely changing data, invalidated through signals (see ws_lock.signals)"""
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import Group
+from .models import GroupTypeVisibility, Item, ItemLock
+
+
+class VisibilityCache:
+    """
+    Item types visible to each group and groups of each user. Changes made by
+    other processes are not signaled here, so entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # group_id -> (frozenset of visible item types, time.monotonic() of load)
+        self.groups = {}
+        # user_id -> (frozenset of group ids, time.monotonic() of load)
+        self.users = {}
+        # bumped on every invalidation, so that a lookup which ran
+        # concurrently with a change does not store stale data
+        self._generation = itertools.count()
+        self.generation = next(self._generation)
+
+    def clear(self):
+        self.generation = next(self._generation)
+        self.groups.clear()
+        self.users.clear()
+
+    def invalidate_group(self, group_id):
+        self.generation = next(self._generation)
+        self.groups.pop(group_id, None)
+
+    def invalidate_user(self, user_id):
+        self.generation = next(self._generation)
+        self.users.pop(user_id, None)
+
+    def invalidate_users(self):
+        self.generation = next(self._generation)
+        self.users.clear()
+
+    def _fresh(self, entries, key, now):
+        entry = entries.get(key)
+        if entry is None or now - entry[1] >= self.ttl:
+            return None
+        return entry[0]
+
+    def cached_visible_types(self, user):
+        """Visible item types of user, None when not cached"""
+        now = time.monotonic()
+        group_ids = self._fresh(self.users, user.id, now)
+        if group_ids is None:
+            return None
+        types = set()
+        for group_id in group_ids:
+            group_types = self._fresh(self.groups, group_id, now)
+            if group_types is None:
+                return None
+            types.update(group_types)
+        return frozenset(types)
+
+    def visible_types(self, user):
+        """Visible item types of user, loaded from database when missing"""
+        types = self.cached_visible_types(user)
+        if types is not None:
+            return types
+
+        generation = self.generation
+        now = time.monotonic()
+        group_ids = cached_group_ids = self._fresh(self.users, user.id, now)
+        if group_ids is None:
+            group_ids = frozenset(Group.objects.filter(user=user).values_list('id', flat=True))
+        known = {group_id: self._fresh(self.groups, group_id, now) for group_id in group_ids}
+        missing = {group_id: set() for group_id, t in known.items() if t is None}
+        if missing:
+            for group_id, item_type in GroupTypeVisibility.objects.filter(
+                group_id__in=missing
+            ).values_list('group_id', 'item_type'):
+                missing[group_id].add(item_type)
+
+        types = set()
+        for group_id in group_ids:
+            types.update(missing[group_id] if group_id in missing else known[group_id])
+        if generation == self.generation:
+            if cached_group_ids is None:
+                self.users[user.id] = (group_ids, now)
+            self.groups.update((group_id, (frozenset(t), now)) for group_id, t in missing.items())
+        return frozenset(types)
+
+    async def avisible_types(self, user):
+        types = self.cached_visible_types(user)
+        if types is None:
+            types = await sync_to_async(self.visible_types)(user)
+        return types
+
+
+visibility_cache = VisibilityCache(getattr(settings, 'WS_LOCK_VISIBILITY_TTL', 60))
+
+
+class PermissionCache:
+    """
+    Whether each user has the permissions required to connect, see
+    ws_lock.consumers.resolve_connection. Entries expire after `ttl` seconds,
+    so that permissions revoked by other processes apply.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # user_id -> (bool, time.monotonic() of load)
+        self.users = {}
+        self._generation = itertools.count()
+        self.generation = next(self._generation)
+
+    def clear(self):
+        self.generation = next(self._generation)
+        self.users.clear()
+
+    def invalidate_user(self, user_id):
+        self.generation = next(self._generation)
+        self.users.pop(user_id, None)
+
+    def invalidate_users(self):
+        self.generation = next(self._generation)
+        self.users.clear()
+
+    def allowed(self, user_id):
+        """Whether user may connect, None when not cached"""
+        entry = self.users.get(user_id)
+        if entry is None or time.monotonic() - entry[1] >= self.ttl:
+            return None
+        return entry[0]
+
+    def update(self, user_id, allowed, generation):
+        if generation == self.generation:
+            self.users[user_id] = (allowed, time.monotonic())
+
+
+permission_cache = PermissionCache(getattr(settings, 'WS_LOCK_PERMISSION_TTL', 60))
+
+
+class ItemTypeCache:
+    """Least recently used mapping of item id to item type"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.types = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = itertools.count()
+        self.generation = next(self._generation)
+
+    def __len__(self):
+        return len(self.types)
+
+    def clear(self):
+        with self._lock:
+            self.generation = next(self._generation)
+            self.types.clear()
+
+    def invalidate(self, item_id):
+        with self._lock:
+            self.generation = next(self._generation)
+            self.types.pop(item_id, None)
+
+    def update(self, item_types, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            for item_id, item_type in item_types.items():
+                self.types[item_id] = item_type
+                self.types.move_to_end(item_id)
+            while len(self.types) > self.maxsize:
+                self.types.popitem(last=False)
+
+    def cached_item_types(self, items):
+        """Item types of cached items and the list of the missing ones"""
+        found, missing = {}, []
+        with self._lock:
+            for item_id in items:
+                item_type = self.types.get(item_id)
+                if item_type is None:
+                    missing.append(item_id)
+                else:
+                    self.types.move_to_end(item_id)
+                    found[item_id] = item_type
+        return found, missing
+
+    def item_types(self, items):
+        """Item types of existing items, loaded from database when missing"""
+        found, missing = self.cached_item_types(items)
+        if missing:
+            generation = self.generation
+            loaded = dict(Item.objects.filter(id__in=missing).values_list('id', 'item_type'))
+            self.update(loaded, generation)
+            found.update(loaded)
+        return found
+
+    async def aitem_types(self, items):
+        found, missing = self.cached_item_types(items)
+        if missing:
+            found.update(await sync_to_async(self.item_types)(missing))
+        return found
+
+
+item_type_cache = ItemTypeCache(getattr(settings, 'WS_LOCK_ITEM_TYPE_CACHE_SIZE', 250_000))
+
+
+class LockSnapshotCache:
+    """
+    Active locks of each item type, loaded once from database then kept up to
+    date with the lock updates seen by this process. Since updates of other
+    processes may be missed, entries are reloaded after `ttl` seconds.
+
+    Locks are read from ItemLock rows whatever the lock backend: with backends
+    writing behind (see ws_lock.backends.WriteBehindLockBackend) a lock changed
+    just before a load may be missing until the entry is reloaded.
+    """
+    # number of recently applied update ids, each update reaches every consumer of the process
+    applied_size = 1000
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        # item_type -> {item_id: user_id}
+        self.locks = {}
+        # item_type -> time.monotonic() of load
+        self.loaded = {}
+        # event ids of updates applied recently
+        self.applied = OrderedDict()
+        self._generation = itertools.count()
+        # bumped when cleared, and for each item type when an update is applied
+        self.generation = next(self._generation)
+        self.type_generations = {}
+
+    def clear(self):
+        self.generation = next(self._generation)
+        self.locks.clear()
+        self.loaded.clear()
+        self.applied.clear()
+        self.type_generations.clear()
+
+    def apply(self, item_type, payload, event_id=None):
+        """Update active locks of item_type with a lock update payload, once per event_id"""
+        if event_id is not None:
+            if event_id in self.applied:
+                return
+            self.applied[event_id] = None
+            if len(self.applied) > self.applied_size:
+                self.applied.popitem(last=False)
+        self.type_generations[item_type] = next(self._generation)
+        locks = self.locks.get(item_type)
+        if locks is None:
+            return
+        for lock in payload:
+            if lock['locked']:
+                locks[lock['item']] = lock['user']
+            elif locks.get(lock['item']) == lock['user']:
+                del locks[lock['item']]
+
+    def _load(self, item_types):
+        generation = self.generation
+        type_generations = {item_type: self.type_generations.get(item_type) for item_type in item_types}
+        loaded = {item_type: {} for item_type in item_types}
+        for item_id, user_id, item_type in ItemLock.objects.filter(
+            locked=True, item__item_type__in=item_types
+        ).values_list('item_id', 'user_id', 'item__item_type'):
+            loaded[item_type][item_id] = user_id
+        # an update applied meanwhile may be missing from loaded data
+        if generation == self.generation:
+            now = time.monotonic()
+            for item_type, locks in loaded.items():
+                if self.type_generations.get(item_type) == type_generations[item_type]:
+                    self.locks[item_type] = locks
+                    self.loaded[item_type] = now
+        return loaded
+
+    async def snapshot(self, item_types):
+        """Payload of every active lock on items of given types"""
+        now = time.monotonic()
+        locks = {}
+        missing = []
+        for item_type in item_types:
+            if item_type in self.locks and now - self.loaded[item_type] < self.ttl:
+                locks[item_type] = self.locks[item_type]
+            else:
+                missing.append(item_type)
+        if missing:
+            locks.update(await sync_to_async(self._load)(missing))
+        return [
+            {'item': item_id, 'user': user_id, 'locked': True}
+            for item_type in sorted(locks)
+            for item_id, user_id in sorted(locks[item_type].items())
+        ]
+
+
+lock_snapshot_cache = LockSnapshotCache(getattr(settings, 'WS_LOCK_SNAPSHOT_TTL', 60))
@@ -1,12 +1,23 @@
-import threading
+import asyncio
+import logging
+import time
 from asgiref.sync import sync_to_async
-from collections import defaultdict
+from django.utils.functional import cached_property
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
-from .models import Item, ItemLock, GroupTypeVisibility
+from .backends import get_lock_backend
+from .batching import get_release_coordinator
+from .cache import lock_snapshot_cache, permission_cache, visibility_cache
+from .events import broadcast_locks, consumer_group, event_log
+from .leases import lease_keeper
+from .limits import TokenBucket, limit_counters, user_buckets
+from .metrics import metrics
+from .pgnotify import lock_listener, pg_notify_enabled
+from .wire import PackedFormat, SequencedJSONFormat, SequencedPackedFormat, negotiate
+
+logger = logging.getLogger(__name__)
 
 
 def can_user_connect(user):
-    print('db-connection-1', threading.get_ident())
     return user and not user.is_anonymous and user.is_active and user.has_perms([
         'ws_lock.view_itemlock',
         'ws_lock.add_itemlock',
@@ -15,128 +26,385 @@ def can_user_connect(user):
     ])
 
 
+async def resolve_connection(user):
+    """
+    Whether user may connect and the item types they can see, from caches or
+    with a single thread hop
+    """
+    if user is None or user.is_anonymous or not user.is_active:
+        return False, frozenset()
+    allowed = permission_cache.allowed(user.id)
+    visible_types = visibility_cache.cached_visible_types(user)
+    if allowed is None or (allowed and visible_types is None):
+        @sync_to_async
+        def _inner():
+            generation = permission_cache.generation
+            allowed = can_user_connect(user)
+            permission_cache.update(user.id, allowed, generation)
+            return allowed, visibility_cache.visible_types(user) if allowed else frozenset()
+
+        with metrics.timer('connect_authorization'):
+            allowed, visible_types = await _inner()
+    return allowed, visible_types if allowed else frozenset()
+
+
 class ItemLockConsumer(AsyncJsonWebsocketConsumer):
+    # dotted path to the class which keeps track of locks, see ws_lock.backends
+    lock_backend = 'ws_lock.backends.ORMLockBackend'
+    # release locks of users disconnecting together with one query, see ws_lock.batching
+    batch_disconnects = False
+    # encode lock updates once for every recipient instead of once per recipient,
+    # encode_json() may be overridden with a faster encoder
+    preencode_locks = False
+    # subprotocols of formats of lock updates offered to clients, see ws_lock.wire
+    wire_formats = (PackedFormat.subprotocol, SequencedJSONFormat.subprotocol, SequencedPackedFormat.subprotocol)
+    # send the updates of every item type changed by one action as a single frame,
+    # parts still missing after merge_timeout seconds are not waited for
+    merge_events = False
+    merge_timeout = 0.05
+    # seconds during which lock requests are collected and only the latest set
+    # of items is applied, None to apply every message as it comes
+    coalesce_window = None
+    # (requests per second, burst) allowed for each connection and for each user
+    # over all their connections to the process, see ws_lock.limits, None for no limit
+    rate_limit = None
+    user_rate_limit = None
+    # maximum number of items in a message and locked through a connection
+    max_items = None
+    # messages over a limit are answered {"error": reason} with 'reject', or the connection is closed with 'close'
+    limit_action = 'reject'
+    # lock updates are merged by item in a buffer while the client is slow to receive them,
+    # the connection is closed when more than outbox_size items are pending or the oldest
+    # pending update is outbox_lag seconds old; None to send updates right away
+    outbox_size = None
+    outbox_lag = 5
 
-    async def send_locks(self, locks):
-        # group locks by item_type
-        grouped_locks = defaultdict(list)
-        for lock in locks:
-            grouped_locks[lock.item.item_type].append(lock)
+    def __init__(self, *args, **kwargs):
+        # keyword arguments of as_asgi() override class attributes
+        for key, value in kwargs.items():
+            if not hasattr(type(self), key):
+                raise TypeError(f'{type(self).__name__} has no attribute {key!r}')
+            setattr(self, key, value)
+        super().__init__(*args)
 
-        # send each lock on its own group
-        for group, group_locks in grouped_locks.items():
-            payload = [{'item': l.item_id, 'user': l.user_id, 'locked': l.locked} for l in group_locks]
-            await self.channel_layer.group_send(f'type-{group}', {'type': 'receive.locks', 'data': payload})
+    @cached_property
+    def backend(self):
+        return get_lock_backend(self.lock_backend)
+
+    async def send_locks(self, locks):
+        with metrics.timer('send_locks'):
+            await broadcast_locks(self.channel_layer, locks, encode=self.encode_json if self.preencode_locks else None)
 
     async def receive_locks(self, event):
-        print('send', threading.get_ident())
-        await self.send_json(event['data'])
+        metrics.inc('updates_received')
+        # keep snapshot up to date with updates sent by other processes
+        lock_snapshot_cache.apply(event['item_type'], event['data'], event['id'])
+        seq = event_log.receive(event['item_type'], event['id'], event['data'])
+        parts = self.visible_types.intersection(event.get('parts', ()))
+        if self.merge_events and len(parts) > 1:
+            await self._merge_lock_update(event, parts, seq)
+        else:
+            await self.flush_merged()
+            await self.queue_lock_update(event['data'], event.get('text'), seqs={event['item_type']: seq})
+
+    async def _merge_lock_update(self, event, parts, seq):
+        if self.merged is not None and self.merged['action'] != event['action']:
+            # updates are not reordered
+            await self.flush_merged()
+        if self.merged is None:
+            self.merged = {
+                'action': event['action'],
+                'waiting': set(parts),
+                'data': [],
+                'seqs': {},
+                'timeout': asyncio.get_running_loop().call_later(
+                    self.merge_timeout, lambda: asyncio.ensure_future(self.flush_merged())
+                ),
+            }
+        self.merged['waiting'].discard(event['item_type'])
+        self.merged['data'].extend(event['data'])
+        self.merged['seqs'][event['item_type']] = seq
+        if not self.merged['waiting']:
+            await self.flush_merged()
+
+    async def flush_merged(self):
+        """Send the parts of an action merged so far"""
+        merged, self.merged = self.merged, None
+        if merged is not None:
+            merged['timeout'].cancel()
+            await self.queue_lock_update(merged['data'], seqs=merged['seqs'])
+
+    async def queue_lock_update(self, data, text=None, seqs=None):
+        """Send lock update to client, through the outbox when enabled"""
+        if self.outbox_size is None:
+            await self.send_lock_update(data, text, seqs)
+            return
+        if self.lagging:
+            return
+
+        if not self.outbox:
+            self.outbox_since = time.monotonic()
+            self.outbox_text = text
+        else:
+            # encoded text of a single update is of no use anymore
+            self.outbox_text = None
+        for lock in data:
+            # latest state of an item wins
+            self.outbox.pop(lock['item'], None)
+            self.outbox[lock['item']] = lock
+        for item_type, seq in (seqs or {}).items():
+            self.outbox_seqs[item_type] = max(seq, self.outbox_seqs.get(item_type, 0))
+
+        if len(self.outbox) > self.outbox_size or time.monotonic() - self.outbox_since > self.outbox_lag:
+            # client will get a snapshot of current locks when reconnecting
+            limit_counters['lagging'] += 1
+            self.lagging = True
+            self._clear_outbox()
+            await self.close(code=1013)
+        elif self.outbox_task is None:
+            self.outbox_task = asyncio.ensure_future(self._send_outbox())
+
+    async def _send_outbox(self):
+        while self.outbox and not self.lagging:
+            data, text, seqs = list(self.outbox.values()), self.outbox_text, self.outbox_seqs
+            self.outbox, self.outbox_text, self.outbox_seqs = {}, None, {}
+            await self.send_lock_update(data, text, seqs)
+        self.outbox_task = None
+
+    def _clear_outbox(self):
+        self.outbox, self.outbox_text, self.outbox_seqs = {}, None, {}
+
+    async def send_lock_update(self, data, text=None, seqs=None, snapshot=False):
+        """
+        Send lock update to client, text is data already encoded as JSON, seqs the
+        sequence of each item type it covers, for sequenced formats
+        """
+        if self.wire_format.sequenced:
+            frame = self.wire_format.encode(data, event_log.epoch, seqs or {}, snapshot)
+            if self.wire_format.binary:
+                await self.send(bytes_data=frame)
+            else:
+                await self.send_json(frame)
+        elif self.wire_format.binary:
+            await self.send(bytes_data=self.wire_format.encode(data))
+        elif text is not None:
+            await self.send(text_data=text)
+        else:
+            await self.send_json(data)
 
     async def connection_groups(self):
         """Connection groups based on current user"""
-        print('db-connection-2', threading.get_ident())
         user = self.scope.get('user')
-        if user is None or user.is_anonymous or not user.is_active:
-            return []
-
-        visible_types = GroupTypeVisibility.objects.filter(group__in=user.groups.all()).values_list('item_type', flat=True).distinct()
-        groups = [f"type-{t}" async for t in visible_types]
-        print('Groups', groups, 'for user', user)
-        return groups
+        # users who may not connect do not join any group
+        self.may_connect, visible_types = await resolve_connection(user)
+        self.visible_types = visible_types
+        return [consumer_group(t, self.channel_name) for t in sorted(visible_types)]
 
     async def websocket_connect(self, message):
+        # items locked through this connection
+        self.held_items = set()
+        self.wire_format = negotiate(self.scope.get('subprotocols', []), self.wire_formats)
+        self.may_connect = False
+        self.visible_types = frozenset()
+        # updates of an action waiting for its other parts, see merge_events
+        self.merged = None
+        # items to lock once coalesce_window is over, and the task applying them
+        self.desired_items = None
+        self.coalesce_task = None
+        self.bucket = self.user_bucket = None
+        # item_id -> latest lock update not sent yet, see outbox_size
+        self.outbox = {}
+        self.outbox_text = None
+        self.outbox_seqs = {}
+        self.outbox_since = None
+        self.outbox_task = None
+        self.lagging = False
         # set connection groups at runtime
-        self.groups = await self.connection_groups()
+        with metrics.timer('group_resolution'):
+            self.groups = await self.connection_groups()
+        event_log.subscribe(self.visible_types)
+        if pg_notify_enabled() and self.may_connect:
+            # updates are received from the worker's listener, see ws_lock.pgnotify
+            self.groups = []
+            lock_listener.register(self)
         await super().websocket_connect(message)
 
+    async def websocket_disconnect(self, message):
+        event_log.unsubscribe(self.visible_types)
+        lock_listener.unregister(self)
+        if self.merged is not None:
+            self.merged['timeout'].cancel()
+            self.merged = None
+        if self.outbox_task is not None:
+            self.outbox_task.cancel()
+            self.outbox_task = None
+        await super().websocket_disconnect(message)
+
     async def connect(self):
         user = self.scope.get('user')
-        print('connect', threading.get_ident())
-        accept = await sync_to_async(can_user_connect)(user)
-        print('User', user, 'was accepted?', accept)
+        # resolved with connection groups
+        accept = self.may_connect
+        metrics.inc('connections_accepted' if accept else 'connections_rejected')
         if accept:
-            await super().connect()
+            await self.backend.start()
+            await self.accept(self.wire_format.subprotocol)
+            lease_keeper.register(self)
+            if self.rate_limit:
+                self.bucket = TokenBucket(*self.rate_limit)
+            if self.user_rate_limit:
+                self.user_bucket = user_buckets.acquire(user.id, *self.user_rate_limit)
+            if self.wire_format.sequenced:
+                # client asks for a snapshot or missed updates, see resume()
+                return
+            # let client know which items are already locked
+            snapshot = await lock_snapshot_cache.snapshot(self.visible_types)
+            if snapshot:
+                await self.send_lock_update(snapshot)
         else:
             await self.close()
 
-    async def _update_locks(self, items):
-        print('db-connection-3', threading.get_ident())
-        user = self.scope['user']
+    async def resume(self, epoch, seqs):
+        """
+        Send the updates missed since the last sequence of each item type received by
+        the client, or a snapshot of active locks when some of them are not known anymore
+        """
+        if epoch != event_log.epoch or not isinstance(seqs, dict):
+            seqs = {}
+        # pending updates were logged, so they are sent again below
+        self._clear_outbox()
+        missed = {}
+        for item_type in self.visible_types:
+            seq = seqs.get(str(item_type))
+            events = event_log.since(item_type, seq) if isinstance(seq, int) else None
+            if events is None:
+                break
+            missed[item_type] = events
+        else:
+            for item_type, events in sorted(missed.items()):
+                for seq, payload in events:
+                    await self.send_lock_update(payload, seqs={item_type: seq})
+            return
 
-        @sync_to_async
-        def _inner():
-            # validate items by filtering with user-group-permission
-            validated_items = list(
-                Item.objects.filter(
-                    item_type__in=GroupTypeVisibility.objects.filter(
-                        group__in=user.groups.all()
-                    ).values_list("item_type"),
-                    id__in=items,
-                ).values_list("id", flat=True)
-            )
-            # get pending locks
-            pending_locks = user.lock_items.filter(locked=True)
-            # left locks are those which item_id is no more present in received data
-            left_locks_ids = list(
-                pending_locks.exclude(item_id__in=validated_items).values_list(
-                    "id", flat=True
-                )
-            )
-            pending_locks.exclude(item_id__in=validated_items).update(locked=False)
-            # get which locks need to be created and then create them
-            already_existing = set(
-                ItemLock.objects.filter(
-                    locked=True, item_id__in=validated_items
-                ).values_list("item_id", flat=True)
-            )
-            ItemLock.objects.bulk_create(
-                [
-                    ItemLock(user=user, item_id=item_id)
-                    for item_id in validated_items
-                    if item_id not in already_existing
-                ]
-            )
-            # get active ad left locks
-            active_locks = list(pending_locks.select_related("item", "user"))
-            left_locks = list(
-                user.lock_items.filter(id__in=left_locks_ids).select_related(
-                    "item", "user"
-                )
-            )
-            return active_locks, left_locks
-
-        active_locks, left_locks = await _inner()
+        # sequences before loading, updates received meanwhile are sent afterwards
+        current = {item_type: event_log.current(item_type) for item_type in self.visible_types}
+        snapshot = await lock_snapshot_cache.snapshot(self.visible_types)
+        await self.send_lock_update(snapshot, seqs=current, snapshot=True)
+
+    @staticmethod
+    def _item_ids(items):
+        return {i for i in items if isinstance(i, int) and not isinstance(i, bool)}
+
+    async def _update_locks(self, requested):
+        # only items which changed since previous message need to be handled
+        added = requested - self.held_items
+        removed = self.held_items - requested
+        if not added and not removed:
+            return []
+
+        user = self.scope['user']
+        with metrics.timer('update_locks'):
+            active_locks, left_locks = await self.backend.change_locks(user, sorted(added), sorted(removed))
+        self.held_items.difference_update(lock.item_id for lock in left_locks)
+        self.held_items.update(lock.item_id for lock in active_locks)
         # return every lock which needs to be sent
-        print('Locks for user', user, ':', active_locks + left_locks)
         return active_locks + left_locks
 
+    async def _limit_exceeded(self, reason):
+        limit_counters[reason] += 1
+        if self.limit_action == 'close':
+            limit_counters['closed'] += 1
+            await self.close(code=1008)
+        else:
+            await self.send_json({'error': reason})
+
     async def receive_json(self, content):
+        if (self.bucket is not None and not self.bucket.consume()) or (
+            self.user_bucket is not None and not self.user_bucket.consume()
+        ):
+            await self._limit_exceeded('throttled')
+            return
+
+        resume = content.get('resume')
+        if isinstance(resume, dict) and self.wire_format.sequenced:
+            await self.resume(resume.get('epoch'), resume.get('seq'))
+            return
+
+        # either the full set of items to lock, or items to add and remove from current ones
         items = content.get('items')
-        if not isinstance(items, list):
+        acquire = content.get('acquire', [])
+        release = content.get('release', [])
+        current = self.held_items if self.desired_items is None else self.desired_items
+        if isinstance(items, list):
+            lists = [items]
+        elif isinstance(acquire, list) and isinstance(release, list) and (acquire or release):
+            lists = [acquire, release]
+        else:
+            return
+        if self.max_items is not None and any(len(l) > self.max_items for l in lists):
+            await self._limit_exceeded('too_many_items')
+            return
+        if isinstance(items, list):
+            requested = self._item_ids(items)
+        else:
+            requested = (current | self._item_ids(acquire)) - self._item_ids(release)
+        if self.max_items is not None and len(requested) > self.max_items:
+            await self._limit_exceeded('too_many_items')
+            return
+
+        metrics.inc('lock_requests')
+        if self.coalesce_window:
+            # newer requests replace this one until the task applies it
+            self.desired_items = requested
+            if self.coalesce_task is None:
+                self.coalesce_task = asyncio.ensure_future(self._apply_desired_items())
             return
 
         # process locks and then re-send them
-        print('receive', threading.get_ident())
-        updated_locks = await self._update_locks(items)
+        updated_locks = await self._update_locks(requested)
         await self.send_locks(updated_locks)
 
-    async def _leave_locks_on_close(self):
-        print('db-connection-4', threading.get_ident())
+    async def _apply_desired_items(self):
+        try:
+            await asyncio.sleep(self.coalesce_window)
+            # requests received while applying are applied right after
+            while self.desired_items is not None:
+                requested, self.desired_items = self.desired_items, None
+                try:
+                    updated_locks = await self._update_locks(requested)
+                except Exception:
+                    # nothing else reports the failure, the client may send its request again
+                    logger.exception('Coalesced lock request failed')
+                    await self.send_json({'error': 'update_failed'})
+                    continue
+                await self.send_locks(updated_locks)
+        finally:
+            # a failed or cancelled task must not block later requests
+            self.coalesce_task = None
+
+    async def _leave_locks_on_close(self, items):
+        # other connections of the same user keep their locks
         user = self.scope['user']
-        # fetch locked elements from database
-        user_locks = [
-            lock
-            async for lock in user.lock_items.filter(locked=True).select_related(
-                "item", "user"
-            )
-        ]
-        # update locks
-        await user.lock_items.filter(locked=True).aupdate(locked=False)
-        return user_locks
+        return await self.backend.release_locks(user, sorted(items)) if items else []
 
     async def disconnect(self, code):
         # clean all open inspections
-        left_locks = await self._leave_locks_on_close()
+        lease_keeper.unregister(self)
+        if self.user_bucket is not None:
+            user_buckets.release(self.scope['user'].id)
+            self.user_bucket = None
+        if self.coalesce_task is not None:
+            # a change being applied must complete for held_items to be accurate
+            self.desired_items = None
+            await asyncio.gather(self.coalesce_task, return_exceptions=True)
+        held_items, self.held_items = self.held_items, set()
+        metrics.inc('disconnections')
+        if self.batch_disconnects:
+            # locks are sent to others by the coordinator
+            if held_items:
+                with metrics.timer('disconnect_release'):
+                    await get_release_coordinator(self.backend).release_locks(self.scope['user'], held_items)
+            return
+        with metrics.timer('disconnect_release'):
+            left_locks = await self._leave_locks_on_close(held_items)
         # send message to others
-        print('disconnect', threading.get_ident())
         await self.send_locks(left_locks)
@@ -0,0 +1,164 @@
+import asyncio
+import itertools
+import random
+import zlib
+from collections import defaultdict, deque
+from django.conf import settings
+from .cache import item_type_cache, lock_snapshot_cache
+from .pgnotify import notify_events, pg_notify_enabled
+
+
+def group_shards(item_type):
+    """
+    Number of groups the consumers of an item type are spread over, from
+    WS_LOCK_GROUP_SHARDS: a number for every type, or a dict of item type to number
+    """
+    shards = getattr(settings, 'WS_LOCK_GROUP_SHARDS', 1)
+    if isinstance(shards, dict):
+        return shards.get(item_type, 1)
+    return shards
+
+
+def type_group(item_type, shard=None):
+    """Channel layer group of consumers which can see items of given type"""
+    if shard is None:
+        return f'type-{item_type}'
+    return f'type-{item_type}-{shard}'
+
+
+def type_groups(item_type):
+    """Every group of consumers which can see items of given type"""
+    shards = group_shards(item_type)
+    if shards <= 1:
+        return [type_group(item_type)]
+    return [type_group(item_type, shard) for shard in range(shards)]
+
+
+def consumer_group(item_type, channel_name):
+    """Group joined by the consumer of a channel for given type"""
+    shards = group_shards(item_type)
+    if shards <= 1:
+        return type_group(item_type)
+    return type_group(item_type, zlib.crc32(channel_name.encode()) % shards)
+
+
+class EventLog:
+    """
+    Recent lock updates received by this process, numbered by a monotonic
+    sequence per item type, so that a reconnecting client only gets the updates
+    it missed (see ItemLockConsumer.resume).
+
+    Sequences are only meaningful within this process, identified by `epoch`,
+    and while at least one of its consumers listens to the item type: when the
+    last one leaves, updates are missed, so the sequence skips a number to make
+    earlier ones unresumable.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._ids = itertools.count()
+        self.clear()
+
+    def clear(self):
+        self.epoch = random.getrandbits(32)
+        # item_type -> last sequence
+        self.seqs = {}
+        # item_type -> deque of (seq, event_id, payload)
+        self.events = {}
+        # item_type -> {event_id: seq}, an update is delivered once to every consumer
+        self.received = {}
+        # item_type -> number of consumers of this process in its group
+        self.listeners = defaultdict(int)
+
+    def next_event_id(self):
+        return f'{self.epoch}-{next(self._ids)}'
+
+    def subscribe(self, item_types):
+        for item_type in item_types:
+            self.listeners[item_type] += 1
+
+    def unsubscribe(self, item_types):
+        for item_type in item_types:
+            self.listeners[item_type] -= 1
+            if self.listeners[item_type] <= 0:
+                del self.listeners[item_type]
+                self.events.pop(item_type, None)
+                self.received.pop(item_type, None)
+                self.seqs[item_type] = self.seqs.get(item_type, 0) + 1
+
+    def current(self, item_type):
+        return self.seqs.get(item_type, 0)
+
+    def receive(self, item_type, event_id, payload):
+        """Sequence of an update, which is logged the first time it is received"""
+        received = self.received.setdefault(item_type, {})
+        seq = received.get(event_id)
+        if seq is not None:
+            return seq
+        seq = self.seqs[item_type] = self.current(item_type) + 1
+        events = self.events.setdefault(item_type, deque())
+        events.append((seq, event_id, payload))
+        received[event_id] = seq
+        if len(events) > self.size:
+            _seq, old_id, _payload = events.popleft()
+            del received[old_id]
+        return seq
+
+    def since(self, item_type, seq):
+        """(seq, payload) of updates after seq, None when some of them are not kept anymore"""
+        current = self.current(item_type)
+        if seq > current:
+            return None
+        events = self.events.get(item_type, ())
+        if seq < current and (not events or events[0][0] > seq + 1):
+            return None
+        return [(event_seq, payload) for event_seq, _event_id, payload in events if event_seq > seq]
+
+
+event_log = EventLog(getattr(settings, 'WS_LOCK_EVENT_LOG_SIZE', 1000))
+
+
+async def broadcast_locks(channel_layer, locks, encode=None):
+    """
+    Send changed locks to the consumers which can see their items.
+
+    When `encode` (an async function) is given, the payload of each group is encoded once
+    here and forwarded as is by every receiving consumer.
+    """
+    # group locks by item_type
+    item_types = await item_type_cache.aitem_types([lock.item_id for lock in locks])
+    grouped_locks = defaultdict(list)
+    for lock in locks:
+        # items deleted meanwhile have no type (and no lock anymore)
+        if lock.item_id in item_types:
+            grouped_locks[item_types[lock.item_id]].append(lock)
+
+    # send each lock on its own group, with the types of every group so that
+    # consumers can merge the parts they receive, see ItemLockConsumer.merge_events
+    action = event_log.next_event_id()
+    parts = sorted(grouped_locks)
+    events = []
+    for group, group_locks in grouped_locks.items():
+        payload = [{'item': l.item_id, 'user': l.user_id, 'locked': l.locked} for l in group_locks]
+        event = {
+            'type': 'receive.locks',
+            'item_type': group,
+            'id': f'{action}:{group}',
+            'action': action,
+            'parts': parts,
+            'data': payload,
+        }
+        lock_snapshot_cache.apply(group, payload, event['id'])
+        if encode is not None:
+            event['text'] = await encode(payload)
+        events.append(event)
+
+    if pg_notify_enabled():
+        await notify_events(events)
+        return
+    # shards of a group are sent to in parallel
+    await asyncio.gather(*(
+        channel_layer.group_send(group, event)
+        for event in events
+        for group in type_groups(event['item_type'])
+    ))
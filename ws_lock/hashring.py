@@ -0,0 +1,20 @@
+import hashlib
+from bisect import bisect
+
+
+class HashRing:
+    """
+    Consistent hashing of keys to nodes: each node is placed at `replicas`
+    points of the ring, so that adding a node only moves about 1/n of the keys.
+    """
+
+    def __init__(self, nodes, replicas=100):
+        self.ring = sorted((self._hash(f'{node}-{n}'), node) for node in nodes for n in range(replicas))
+        self.points = [point for point, _node in self.ring]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def node(self, key):
+        return self.ring[bisect(self.points, self._hash(key)) % len(self.ring)][1]
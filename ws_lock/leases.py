@@ -0,0 +1,97 @@
+"""
+Lock leases: when WS_LOCK_LEASE_SECONDS is set, locks expire unless the worker
+which holds them keeps extending them, so locks of a crashed worker are
+eventually released by the others.
+"""
+import asyncio
+import logging
+import weakref
+from datetime import timedelta
+from asgiref.sync import sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+from .events import broadcast_locks
+from .models import ItemLock
+
+logger = logging.getLogger(__name__)
+
+
+def lease_duration():
+    seconds = getattr(settings, 'WS_LOCK_LEASE_SECONDS', None)
+    return timedelta(seconds=seconds) if seconds else None
+
+
+def lease_expiry():
+    """Expiry of a lock acquired or extended now, None without leases"""
+    duration = lease_duration()
+    return timezone.now() + duration if duration else None
+
+
+class LeaseKeeper:
+    """
+    Runs once per worker: periodically extends with a single query every lock
+    held by local consumers (heartbeat) then releases every expired lock and
+    broadcasts them (reaper).
+    """
+    batch_size = 1000
+
+    def __init__(self):
+        self.consumers = weakref.WeakSet()
+        self._task = None
+
+    def register(self, consumer):
+        """Keep locks of consumer alive, consumer must have a held_items set"""
+        if lease_duration() is None:
+            return
+        self.consumers.add(consumer)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    def unregister(self, consumer):
+        self.consumers.discard(consumer)
+        if not self.consumers and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def run(self):
+        while self.consumers:
+            duration = lease_duration()
+            if duration is None:
+                break
+            await asyncio.sleep(duration.total_seconds() / 3)
+            try:
+                await self.heartbeat()
+                await self.reap()
+            except Exception:
+                # locks are extended again at the next round, before they expire
+                logger.exception('Lease heartbeat failed')
+
+    async def heartbeat(self):
+        items = set()
+        for consumer in list(self.consumers):
+            items.update(consumer.held_items)
+        if items:
+            await sync_to_async(self._extend)(sorted(items))
+
+    def _extend(self, items):
+        expires = lease_expiry()
+        for start in range(0, len(items), self.batch_size):
+            # locks without a lease, eg: of the memory and Redis backends, must never expire
+            ItemLock.objects.filter(
+                locked=True, expires__isnull=False, item_id__in=items[start:start + self.batch_size]
+            ).update(expires=expires)
+
+    async def reap(self):
+        # a lock reaped concurrently by another worker is returned to only one of them
+        locks = await ItemLock.objects.filter(expires__lt=timezone.now()).arelease()
+        if not locks:
+            return
+        released = {lock.item_id for lock in locks}
+        for consumer in list(self.consumers):
+            consumer.held_items.difference_update(released)
+        await broadcast_locks(get_channel_layer(), locks)
+
+
+lease_keeper = LeaseKeeper()
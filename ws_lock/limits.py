@@ -0,0 +1,58 @@
+"""
+Limits on what a client can request, so that one client cannot saturate the
+database for everyone, see ItemLockConsumer.rate_limit and max_items.
+"""
+import time
+from collections import Counter
+
+# number of messages rejected and connections closed, by reason
+limit_counters = Counter()
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, and bursts of `burst` requests"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def consume(self, tokens=1):
+        """Take tokens from the bucket, False when there are not enough"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+
+class UserBuckets:
+    """Token bucket shared by the connections of each user to this process"""
+
+    def __init__(self):
+        # user_id -> TokenBucket
+        self.buckets = {}
+        # user_id -> number of connections using the bucket
+        self.connections = Counter()
+
+    def clear(self):
+        self.buckets.clear()
+        self.connections.clear()
+
+    def acquire(self, user_id, rate, burst):
+        if user_id not in self.buckets:
+            self.buckets[user_id] = TokenBucket(rate, burst)
+        self.connections[user_id] += 1
+        return self.buckets[user_id]
+
+    def release(self, user_id):
+        self.connections[user_id] -= 1
+        if self.connections[user_id] <= 0:
+            del self.connections[user_id]
+            self.buckets.pop(user_id, None)
+
+
+user_buckets = UserBuckets()
@@ -0,0 +1,54 @@
+import asyncio
+import time
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from django.db import connection
+from ...backends import ORMLockBackend
+from ...batching import ReleaseCoordinator
+from ...benchmarks import benchmark_database, seed
+from ...cache import item_type_cache
+from ...events import broadcast_locks
+from ...models import ItemLock
+
+
+class Command(BaseCommand):
+    help = 'Compare database statements and wall time of simultaneous disconnects, one by one and batched'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--disconnects', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--locks', type=int, default=2, help='Locks held by each user')
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            size = max(options['disconnects'])
+            users, items = seed(size, size * options['locks'])
+            for count in options['disconnects']:
+                for label, run in (('one by one', self.one_by_one), ('batched', self.batched)):
+                    ItemLock.objects.all().delete()
+                    held = []
+                    for n, user in enumerate(users[:count]):
+                        held.append((user, items[n * options['locks']:(n + 1) * options['locks']]))
+                        ItemLock.objects.acquire(*held[-1])
+                    item_type_cache.clear()
+                    statements = []
+                    with connection.execute_wrapper(lambda execute, sql, *args: statements.append(sql) or execute(sql, *args)):
+                        start = time.perf_counter()
+                        async_to_sync(run)(held)
+                        elapsed = time.perf_counter() - start
+                    assert not ItemLock.objects.filter(locked=True).exists()
+                    self.stdout.write(
+                        f'{count} disconnects {label}: {len(statements)} statements, {elapsed * 1000:.1f}ms'
+                    )
+
+    async def one_by_one(self, held):
+        backend, channel_layer = ORMLockBackend(), get_channel_layer()
+
+        async def disconnect(user, items):
+            await broadcast_locks(channel_layer, await backend.release_locks(user, items))
+
+        await asyncio.gather(*(disconnect(user, items) for user, items in held))
+
+    async def batched(self, held):
+        coordinator = ReleaseCoordinator(ORMLockBackend())
+        await asyncio.gather(*(coordinator.release_locks(user, items) for user, items in held))
@@ -0,0 +1,45 @@
+import time
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from ...consumers import ItemLockConsumer
+from ...wire import JSONFormat
+
+
+class Command(BaseCommand):
+    help = 'Measure the cost per recipient of delivering a lock update, encoded per recipient or once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=2000)
+        parser.add_argument('--locks', type=int, default=20, help='Locks in the update')
+        parser.add_argument('--rounds', type=int, default=5)
+
+    def handle(self, *args, **options):
+        payload = [{'item': n, 'user': n % 7, 'locked': bool(n % 2)} for n in range(options['locks'])]
+        text = async_to_sync(ItemLockConsumer.encode_json)(payload)
+        for label, event in (
+            ('encoded per recipient', {'type': 'receive.locks', 'item_type': 1, 'id': 'bench', 'data': payload}),
+            ('encoded once', {'type': 'receive.locks', 'item_type': 1, 'id': 'bench', 'data': payload, 'text': text}),
+        ):
+            elapsed = async_to_sync(self.fan_out)(event, options['recipients'], options['rounds'])
+            per_recipient = elapsed / (options['recipients'] * options['rounds'])
+            self.stdout.write(f'{label}: {per_recipient * 1e6:.2f}us per recipient')
+
+    async def fan_out(self, event, recipients, rounds):
+        async def base_send(message):
+            pass
+
+        consumers = []
+        for _ in range(recipients):
+            consumer = ItemLockConsumer()
+            consumer.base_send = base_send
+            # state set up when connecting
+            consumer.wire_format = JSONFormat
+            consumer.visible_types = frozenset([1])
+            consumer.merged = None
+            consumers.append(consumer)
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for consumer in consumers:
+                await consumer.receive_locks(event)
+        return time.perf_counter() - start
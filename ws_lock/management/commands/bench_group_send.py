@@ -0,0 +1,43 @@
+import asyncio
+from asgiref.sync import async_to_sync
+from channels.layers import DEFAULT_CHANNEL_LAYER, channel_layers
+from django.core.management.base import BaseCommand
+from ...benchmarks import Timer
+from ...events import type_group
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure the latency of sending a lock update to every member of an item type group, '
+        'split in shards sent to in parallel, with the configured channel layer'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--shards', type=int, nargs='+', default=[1, 4, 16])
+        parser.add_argument('--rounds', type=int, default=10)
+
+    def handle(self, *args, **options):
+        for members in options['members']:
+            for shards in options['shards']:
+                timer = async_to_sync(self.run)(members, shards, options['rounds'])
+                self.stdout.write(f'{members} members, {shards} shard(s): {timer.summary()}')
+
+    async def run(self, members, shards, rounds):
+        channel_layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+        # like ItemLockConsumer with WS_LOCK_GROUP_SHARDS
+        groups = [type_group(1, shard) for shard in range(shards)] if shards > 1 else [type_group(1)]
+        for n in range(members):
+            channel = await channel_layer.new_channel()
+            await channel_layer.group_add(groups[n % shards], channel)
+
+        event = {
+            'type': 'receive.locks', 'item_type': 1, 'id': 'bench',
+            'data': [{'item': 1, 'user': 1, 'locked': True}],
+        }
+        timer = Timer()
+        for _round in range(rounds):
+            with timer():
+                await asyncio.gather(*(channel_layer.group_send(group, event) for group in groups))
+        await channel_layer.flush()
+        return timer
@@ -0,0 +1,43 @@
+import random
+import time
+import tracemalloc
+from django.core.management.base import BaseCommand
+from ...cache import ItemTypeCache
+from ...models import ItemTypes
+
+
+class Command(BaseCommand):
+    help = 'Measure memory and lookup time of the item type cache for a large catalog'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--items', type=int, default=3_000_000)
+        parser.add_argument('--maxsize', type=int, default=None, help='Defaults to the number of items')
+        parser.add_argument('--lookups', type=int, default=100_000)
+        parser.add_argument('--selection', type=int, default=20, help='Items looked up at once')
+
+    def handle(self, *args, **options):
+        items = options['items']
+        types = ItemTypes.values
+        cache = ItemTypeCache(options['maxsize'] or items)
+
+        # values are filled as the database would, without touching it
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        chunk = 100_000
+        for start in range(1, items + 1, chunk):
+            cache.update({item_id: types[item_id % len(types)] for item_id in range(start, min(start + chunk, items + 1))})
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        self.stdout.write(
+            f'{len(cache)} cached items use {used / 2 ** 20:.1f}MiB ({used / max(len(cache), 1):.1f} bytes/item)'
+        )
+
+        selections = [random.sample(range(1, items + 1), options['selection']) for _ in range(options['lookups'])]
+        start = time.perf_counter()
+        for selection in selections:
+            cache.cached_item_types(selection)
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'{options["lookups"]} lookups of {options["selection"]} items: '
+            f'{elapsed * 1e6 / options["lookups"]:.2f}us per lookup'
+        )
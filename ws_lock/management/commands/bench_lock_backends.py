@@ -0,0 +1,66 @@
+import random
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+from redis.exceptions import RedisError
+from ...benchmarks import Timer, benchmark_database, seed
+from ...models import ItemLock
+
+DEFAULT_BACKENDS = [
+    'ws_lock.backends.ORMLockBackend',
+    'ws_lock.backends.MemoryLockBackend',
+    'ws_lock.backends.RedisLockBackend',
+]
+
+
+class Command(BaseCommand):
+    help = 'Compare lock update latency of lock backends on a throwaway database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--backend', action='append', dest='backends', help='Dotted path of a backend, may be repeated')
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--selection', type=int, default=5, help='Items requested by each message')
+        parser.add_argument('--rounds', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with benchmark_database():
+            users, items = seed(options['users'], options['items'])
+            for path in options['backends'] or DEFAULT_BACKENDS:
+                ItemLock.objects.all().delete()
+                random.seed(options['seed'])
+                try:
+                    update, leave, flush = async_to_sync(self.run)(import_string(path)(), users, items, options)
+                except RedisError as exc:
+                    self.stdout.write(f'{path}\n  skipped: {exc}')
+                    continue
+                self.stdout.write(path)
+                self.stdout.write(f'  update {update.summary()}')
+                self.stdout.write(f'  leave  {leave.summary()}')
+                if flush.samples:
+                    self.stdout.write(f'  flush  {flush.summary()}')
+
+    async def run(self, backend, users, items, options):
+        update, leave, flush = Timer(), Timer(), Timer()
+        if hasattr(backend, 'clear'):
+            await backend.clear()
+        # like ItemLockConsumer, only changed items are sent to the backend
+        held = {user.id: set() for user in users}
+        for _round in range(options['rounds']):
+            for user in users:
+                selection = set(random.sample(items, options['selection']))
+                added, removed = selection - held[user.id], held[user.id] - selection
+                with update():
+                    acquired, left = await backend.change_locks(user, sorted(added), sorted(removed))
+                held[user.id].difference_update(lock.item_id for lock in left)
+                held[user.id].update(lock.item_id for lock in acquired)
+        for user in users:
+            with leave():
+                await backend.leave_locks(user)
+        if hasattr(backend, 'flush'):
+            with flush():
+                await backend.flush()
+        if hasattr(backend, 'clear'):
+            await backend.clear()
+        return update, leave, flush
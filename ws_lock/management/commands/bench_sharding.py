@@ -0,0 +1,80 @@
+import asyncio
+import multiprocessing
+import random
+import time
+from channels.layers import DEFAULT_CHANNEL_LAYER, InMemoryChannelLayer, channel_layers
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from ...backends import ShardedLockBackend
+from ...benchmarks import benchmark_database, seed
+from ...models import ItemLock
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure lock change throughput of ShardedLockBackend with 1 to N worker processes, '
+        'each owning one shard, on a throwaway database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Maximum number of worker processes')
+        parser.add_argument('--users', type=int, default=40)
+        parser.add_argument('--items', type=int, default=2000)
+        parser.add_argument('--messages', type=int, default=200, help='Lock changes sent by each worker')
+        parser.add_argument('--selection', type=int, default=5, help='Items requested by each message')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        if options['workers'] > 1 and isinstance(channel_layers[DEFAULT_CHANNEL_LAYER], InMemoryChannelLayer):
+            raise CommandError('Workers must share the channel layer, configure eg: channels_redis')
+
+        context = multiprocessing.get_context('fork')
+        with benchmark_database(shared=True):
+            users, items = seed(options['users'], options['items'])
+            for workers in range(1, options['workers'] + 1):
+                ItemLock.objects.all().delete()
+                # workers open their own connections
+                connections.close_all()
+                barrier = context.Barrier(workers)
+                results = context.Queue()
+                processes = [
+                    context.Process(target=self.worker, args=(n, workers, users, items, options, barrier, results))
+                    for n in range(workers)
+                ]
+                for process in processes:
+                    process.start()
+                samples = [results.get() for _process in processes]
+                for process in processes:
+                    process.join()
+                changes = sum(count for count, _elapsed in samples)
+                elapsed = max(elapsed for _count, elapsed in samples)
+                self.stdout.write(
+                    f'{workers} worker(s): {changes} changes in {elapsed * 1000:.1f}ms, {changes / elapsed:.0f} changes/s'
+                )
+
+    def worker(self, index, workers, users, items, options, barrier, results):
+        asyncio.run(self.run(index, workers, users[index::workers], items, options, barrier, results))
+
+    async def run(self, index, workers, users, items, options, barrier, results):
+        channel_layer = channel_layers.make_backend(DEFAULT_CHANNEL_LAYER)
+        backend = ShardedLockBackend(shards=workers, owned=[index], channel_layer=channel_layer)
+        await backend.start()
+        await asyncio.to_thread(barrier.wait)
+
+        random.seed(options['seed'] + index)
+        held = {user.id: set() for user in users}
+        start = time.perf_counter()
+        for n in range(options['messages']):
+            user = users[n % len(users)]
+            selection = set(random.sample(items, options['selection']))
+            added, removed = selection - held[user.id], held[user.id] - selection
+            acquired, left = await backend.change_locks(user, sorted(added), sorted(removed))
+            held[user.id].difference_update(lock.item_id for lock in left)
+            held[user.id].update(lock.item_id for lock in acquired)
+        elapsed = time.perf_counter() - start
+
+        # keep serving the shard until every worker is done
+        await asyncio.to_thread(barrier.wait)
+        await backend.stop()
+        await backend.flush()
+        results.put((options['messages'], elapsed))
@@ -0,0 +1,50 @@
+import json
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from ...models import ItemLock
+
+
+class Command(BaseCommand):
+    help = 'Delete released locks older than the retention window, in small batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retention', type=float, default=getattr(settings, 'WS_LOCK_HISTORY_RETENTION_DAYS', 30),
+            help='Days of released locks to keep (default: WS_LOCK_HISTORY_RETENTION_DAYS or 30)',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--pause', type=float, default=0.0, help='Seconds to wait between batches')
+        parser.add_argument('--archive', help='Append deleted rows to this file, as JSON lines')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['retention'])
+        released = ItemLock.objects.filter(locked=False, updated__lt=cutoff)
+        if options['dry_run']:
+            self.stdout.write(f'{released.count()} released locks older than {cutoff:%Y-%m-%d %H:%M} would be deleted')
+            return
+
+        archive = open(options['archive'], 'a') if options['archive'] else None
+        deleted = 0
+        try:
+            while True:
+                # each batch is its own short transaction, so no long lock is held on the table
+                batch = list(
+                    released.order_by('id').values('id', 'item_id', 'user_id', 'created', 'updated')[:options['batch_size']]
+                )
+                if not batch:
+                    break
+                if archive is not None:
+                    archive.writelines(json.dumps(row, cls=DjangoJSONEncoder) + '\n' for row in batch)
+                    archive.flush()
+                deleted += ItemLock.objects.filter(id__in=[row['id'] for row in batch], locked=False).delete()[0]
+                if options['pause']:
+                    time.sleep(options['pause'])
+        finally:
+            if archive is not None:
+                archive.close()
+        self.stdout.write(f'Deleted {deleted} released locks older than {cutoff:%Y-%m-%d %H:%M}')
@@ -0,0 +1,58 @@
+import random
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from ...benchmarks import Timer, benchmark_database, seed, seed_locks
+from ...models import GroupTypeVisibility, Item, ItemLock
+
+
+class Command(BaseCommand):
+    help = 'Print query plans and timings of the queries run by ItemLockConsumer on a large ItemLock table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--items', type=int, default=20000)
+        parser.add_argument('--history', type=int, default=20, help='Released locks of each item')
+        parser.add_argument('--active', type=float, default=0.1, help='Fraction of items locked')
+        parser.add_argument('--selection', type=int, default=20, help='Items requested by each message')
+        parser.add_argument('--repeat', type=int, default=50)
+
+    def handle(self, *args, **options):
+        with benchmark_database() as connection:
+            users, items = seed(options['users'], options['items'])
+            seed_locks(users, items, options['history'], options['active'])
+            with connection.cursor() as cursor:
+                cursor.execute('ANALYZE')
+            self.stdout.write(f'{ItemLock.objects.count()} ItemLock rows, {ItemLock.objects.filter(locked=True).count()} active')
+
+            user = ItemLock.objects.filter(locked=True).select_related('user').first().user
+            held = list(user.lock_items.filter(locked=True).values_list('item_id', flat=True))
+            selection = random.sample(items, options['selection'])
+            group_ids = list(Group.objects.filter(user=user).values_list('id', flat=True))
+
+            queries = {
+                'visibility: user groups': Group.objects.filter(user=user).values_list('id', flat=True),
+                'visibility: group types': GroupTypeVisibility.objects.filter(group_id__in=group_ids).values_list('group_id', 'item_type'),
+                'validate: item types': Item.objects.filter(id__in=selection).values_list('id', 'item_type'),
+                'release: held locks': user.lock_items.filter(locked=True, item_id__in=held),
+                'leave: user locks': user.lock_items.filter(locked=True),
+                'memory backend: active locks': ItemLock.objects.filter(locked=True),
+            }
+            for label, queryset in queries.items():
+                timer = Timer()
+                for _ in range(options['repeat']):
+                    with timer():
+                        list(queryset.all())
+                self.stdout.write(self.style.MIGRATE_HEADING(label))
+                self.stdout.write(f'  {queryset.explain()}'.replace('\n', '\n  '))
+                self.stdout.write(f'  {timer.summary()}')
+
+            # writes are timed inside a rolled back transaction
+            timer = Timer()
+            for _ in range(options['repeat']):
+                with transaction.atomic():
+                    with timer():
+                        ItemLock.objects.acquire(user, selection)
+                    transaction.set_rollback(True)
+            self.stdout.write(self.style.MIGRATE_HEADING('acquire: insert on conflict'))
+            self.stdout.write(f'  {timer.summary()}')
@@ -0,0 +1,99 @@
+"""
+Latency histograms of the phases of lock sockets and event counters, recorded
+when WS_LOCK_METRICS is set and exposed in Prometheus text format by
+ws_lock.views.metrics.
+"""
+import time
+from bisect import bisect_left
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from django.conf import settings
+from .limits import limit_counters
+
+# upper bounds of histogram buckets, in seconds
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# reusable, so that disabled timers allocate nothing
+DISABLED_TIMER = nullcontext()
+
+PHASES = {
+    'connect_authorization': 'permissions and visible item types of the user',
+    'group_resolution': 'channel layer groups of the connection, including connect_authorization',
+    'update_locks': 'lock changes applied by the backend',
+    'send_locks': 'broadcast of changed locks',
+    'disconnect_release': 'release of the locks of a closed connection',
+}
+
+
+class Histogram:
+
+    def __init__(self):
+        # count of observations in each bucket, the last one is +Inf
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.buckets[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.clear()
+
+    def clear(self):
+        self.histograms = {phase: Histogram() for phase in PHASES}
+        self.counters = Counter()
+
+    def timer(self, phase):
+        """Context manager recording the time spent in phase, does nothing when disabled"""
+        if not self.enabled:
+            return DISABLED_TIMER
+        return self._timer(phase)
+
+    @contextmanager
+    def _timer(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[phase].observe(time.perf_counter() - start)
+
+    def inc(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def export(self):
+        """Metrics in Prometheus text format"""
+        lines = [
+            '# HELP ws_lock_phase_seconds Latency of the phases of lock sockets.',
+            '# TYPE ws_lock_phase_seconds histogram',
+        ]
+        for phase, histogram in self.histograms.items():
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ('+Inf',), histogram.buckets):
+                cumulative += count
+                lines.append(f'ws_lock_phase_seconds_bucket{{phase="{phase}",le="{bound}"}} {cumulative}')
+            lines.append(f'ws_lock_phase_seconds_sum{{phase="{phase}"}} {histogram.sum}')
+            lines.append(f'ws_lock_phase_seconds_count{{phase="{phase}"}} {histogram.count}')
+        lines += [
+            '# HELP ws_lock_events_total Events of lock sockets.',
+            '# TYPE ws_lock_events_total counter',
+        ]
+        lines += [f'ws_lock_events_total{{event="{name}"}} {count}' for name, count in sorted(self.counters.items())]
+        lines += [
+            '# HELP ws_lock_limit_events_total Messages rejected and connections closed over a limit.',
+            '# TYPE ws_lock_limit_events_total counter',
+        ]
+        lines += [
+            f'ws_lock_limit_events_total{{reason="{reason}"}} {count}'
+            for reason, count in sorted(limit_counters.items())
+        ]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics(getattr(settings, 'WS_LOCK_METRICS', False))
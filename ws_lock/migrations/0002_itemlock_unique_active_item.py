@@ -0,0 +1,32 @@
+# Generated by Django 5.1.7 on 2026-10-18 12:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def release_duplicated_locks(apps, schema_editor):
+    # keep only the oldest active lock of each item
+    ItemLock = apps.get_model('ws_lock', 'ItemLock')
+    oldest = (
+        ItemLock.objects.filter(locked=True)
+        .values('item_id')
+        .annotate(first_id=models.Min('id'))
+        .values_list('first_id', flat=True)
+    )
+    ItemLock.objects.filter(locked=True).exclude(id__in=list(oldest)).update(locked=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ws_lock', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RunPython(release_duplicated_locks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='itemlock',
+            constraint=models.UniqueConstraint(condition=models.Q(('locked', True)), fields=('item',), name='ws_lock_itemlock_unique_active_item'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 12:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ws_lock', '0002_itemlock_unique_active_item'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='itemlock',
+            index=models.Index(condition=models.Q(('locked', True)), fields=['user'], name='ws_lock_itemlock_active_user'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.7 on 2026-10-18 12:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ws_lock', '0003_itemlock_active_user'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='itemlock',
+            index=models.Index(condition=models.Q(('locked', False)), fields=['updated'], name='ws_lock_itemlock_released'),
+        ),
+    ]
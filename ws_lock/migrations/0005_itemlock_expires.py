@@ -0,0 +1,24 @@
+# Generated by Django 5.1.7 on 2026-10-18 12:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ws_lock', '0004_itemlock_released'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='itemlock',
+            name='expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='itemlock',
+            index=models.Index(condition=models.Q(('locked', True)), fields=['expires'], name='ws_lock_itemlock_expires'),
+        ),
+    ]
@@ -1,6 +1,9 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import connections, models
+from django.db.models.sql import Query
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import Group
+from django.utils import timezone
 
 User = get_user_model()
 
@@ -27,12 +30,121 @@ class Item(models.Model):
         return f'{ItemTypes(self.item_type).label}@{self.id}'
 
 
+class ItemLockQuerySet(models.QuerySet):
+
+    def release(self):
+        """
+        Release active locks of this queryset with a single UPDATE ... RETURNING
+        statement and return them. Only filters on ItemLock columns are supported.
+        """
+        queryset = self.filter(locked=True)
+        if sum(1 for count in queryset.query.alias_refcount.values() if count) > 1:
+            raise ValueError('release() does not support filters on related models')
+        connection = connections[queryset.db]
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        where, params = queryset.query.get_compiler(connection=connection).compile(queryset.query.where)
+
+        now = timezone.now()
+        columns = [qn(opts.get_field(name).column) for name in ('id', 'item', 'user')]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'UPDATE {qn(opts.db_table)} '
+                f'SET {qn(opts.get_field("locked").column)} = %s, {qn(opts.get_field("updated").column)} = %s '
+                f'WHERE {where} RETURNING {", ".join(columns)}',
+                [
+                    opts.get_field('locked').get_db_prep_value(False, connection),
+                    opts.get_field('updated').get_db_prep_value(now, connection),
+                    *params,
+                ],
+            )
+            rows = sorted(cursor.fetchall())
+        return [
+            self.model(id=lock_id, item_id=item_id, user_id=user_id, locked=False, updated=now)
+            for lock_id, item_id, user_id in rows
+        ]
+
+    async def arelease(self):
+        return await sync_to_async(self.release)()
+
+
+class ItemLockManager(models.Manager.from_queryset(ItemLockQuerySet)):
+
+    def acquire(self, user, item_ids, expires=None, batch_size=500):
+        """
+        Lock every item which is not already locked, with a single statement
+        which skips conflicting rows, and return the created locks.
+        """
+        return self.acquire_many([(user, item_id) for item_id in item_ids], expires, batch_size)
+
+    def acquire_many(self, requests, expires=None, batch_size=500):
+        """Same as acquire() for a list of (user, item_id) of different users, items must not repeat"""
+        connection = connections[self.db]
+        opts = self.model._meta
+        qn = connection.ops.quote_name
+        (constraint,) = [c for c in opts.constraints if c.name == 'ws_lock_itemlock_unique_active_item']
+        query = Query(self.model, alias_cols=False)
+        condition, condition_params = query.build_where(constraint.condition).as_sql(
+            query.get_compiler(connection=connection), connection
+        )
+
+        now = timezone.now()
+        db_now = opts.get_field('created').get_db_prep_value(now, connection)
+        db_expires = opts.get_field('expires').get_db_prep_value(expires, connection)
+        db_locked = opts.get_field('locked').get_db_prep_value(True, connection)
+        columns = ', '.join(
+            qn(opts.get_field(name).column) for name in ('locked', 'item', 'user', 'created', 'updated', 'expires')
+        )
+        item_column = qn(opts.get_field('item').column)
+
+        users = {item_id: user for user, item_id in requests}
+        locks = []
+        with connection.cursor() as cursor:
+            for start in range(0, len(requests), batch_size):
+                batch = requests[start:start + batch_size]
+                cursor.execute(
+                    f'INSERT INTO {qn(opts.db_table)} ({columns}) '
+                    f'VALUES {", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))} '
+                    f'ON CONFLICT ({item_column}) WHERE {condition} DO NOTHING '
+                    f'RETURNING {qn(opts.pk.column)}, {item_column}',
+                    [
+                        param
+                        for user, item_id in batch
+                        for param in (db_locked, item_id, user.pk, db_now, db_now, db_expires)
+                    ] + list(condition_params),
+                )
+                locks.extend(
+                    self.model(id=lock_id, item_id=item_id, user=users[item_id], created=now, updated=now, expires=expires)
+                    for lock_id, item_id in sorted(cursor.fetchall(), key=lambda row: row[1])
+                )
+        return locks
+
+
 class ItemLock(models.Model):
     locked = models.BooleanField(default=True)
     item = models.ForeignKey(Item, related_name='locks', on_delete=models.CASCADE)
     user = models.ForeignKey(User, related_name='lock_items', on_delete=models.CASCADE)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    # locks with a lease are released once expired, see ws_lock.leases
+    expires = models.DateTimeField(null=True, blank=True)
+
+    objects = ItemLockManager()
+
+    class Meta:
+        constraints = [
+            # an item can be locked by a single user at once
+            models.UniqueConstraint(
+                fields=['item'], condition=models.Q(locked=True), name='ws_lock_itemlock_unique_active_item'
+            ),
+        ]
+        indexes = [
+            # locks held by a user, released rows do not grow it
+            models.Index(fields=['user'], condition=models.Q(locked=True), name='ws_lock_itemlock_active_user'),
+            # released history, to be compacted
+            models.Index(fields=['updated'], condition=models.Q(locked=False), name='ws_lock_itemlock_released'),
+            models.Index(fields=['expires'], condition=models.Q(locked=True), name='ws_lock_itemlock_expires'),
+        ]
 
     def __str__(self):
         return f'Lock on {self.item} by {self.user}'
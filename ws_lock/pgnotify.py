@@ -0,0 +1,132 @@
+"""
+Delivery of lock updates through PostgreSQL LISTEN/NOTIFY instead of the
+channel layer, enabled with WS_LOCK_PG_NOTIFY: updates are sent with one
+NOTIFY per item type and each worker runs one LISTEN connection which hands
+them to its local consumers.
+"""
+import asyncio
+import json
+import logging
+import weakref
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+from .models import ItemTypes
+
+logger = logging.getLogger(__name__)
+
+# NOTIFY payloads must be shorter than 8000 bytes
+MAX_PAYLOAD = 7900
+
+
+def pg_notify_enabled():
+    return getattr(settings, 'WS_LOCK_PG_NOTIFY', False)
+
+
+def notify_channel(item_type):
+    return f'ws_lock_type_{item_type}'
+
+
+def _payloads(event):
+    """Encoded event, split into several events when too large for a single NOTIFY"""
+    payload = json.dumps(event, separators=(',', ':'))
+    if len(payload.encode()) <= MAX_PAYLOAD or len(event['data']) < 2:
+        return [payload]
+    half = len(event['data']) // 2
+    # parts are not merged by consumers anymore
+    return [
+        payload
+        for n, data in enumerate((event['data'][:half], event['data'][half:]))
+        for payload in _payloads({
+            **event, 'id': f'{event["id"]}.{n}', 'action': f'{event["action"]}.{n}',
+            'parts': [event['item_type']], 'data': data,
+        })
+    ]
+
+
+@sync_to_async
+def notify_events(events):
+    """Send receive.locks events of broadcast_locks with a single statement"""
+    params = []
+    for event in events:
+        event = {key: value for key, value in event.items() if key != 'text'}
+        for payload in _payloads(event):
+            params.extend((notify_channel(event['item_type']), payload))
+    if params:
+        with connections['default'].cursor() as cursor:
+            cursor.execute('SELECT ' + ', '.join(['pg_notify(%s, %s)'] * (len(params) // 2)), params)
+
+
+class LockListener:
+    """
+    Runs once per worker: listens to the notifications of every item type and
+    calls receive_locks() of the local consumers which can see it, in order.
+    """
+    retry_delay = 1
+
+    def __init__(self):
+        # item_type -> consumers
+        self.consumers = defaultdict(weakref.WeakSet)
+        self._task = None
+
+    def register(self, consumer):
+        """Deliver updates of consumer.visible_types to consumer"""
+        for item_type in consumer.visible_types:
+            self.consumers[item_type].add(consumer)
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    def unregister(self, consumer):
+        for item_type in consumer.visible_types:
+            self.consumers[item_type].discard(consumer)
+        if not any(self.consumers.values()) and self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _connection_params(self):
+        params = connections['default'].get_connection_params()
+        # synchronous cursor and adapters of Django
+        params.pop('cursor_factory', None)
+        params.pop('context', None)
+        return params
+
+    async def run(self):
+        from psycopg import AsyncConnection, OperationalError
+
+        while True:
+            try:
+                async with await AsyncConnection.connect(autocommit=True, **self._connection_params()) as conn:
+                    for item_type in ItemTypes.values:
+                        await conn.execute(f'LISTEN {notify_channel(item_type)}')
+                    async for notify in conn.notifies():
+                        await self.receive(notify.payload)
+            except OperationalError:
+                # updates sent meanwhile are lost, clients get them with their next snapshot
+                logger.exception('Lock listener connection lost, reconnecting')
+                await asyncio.sleep(self.retry_delay)
+            except Exception:
+                # every consumer of the worker depends on the listener, which must keep running
+                logger.exception('Lock listener failed, reconnecting')
+                await asyncio.sleep(self.retry_delay)
+
+    async def receive(self, payload):
+        """Dispatch a notification, a bad one is logged and skipped"""
+        try:
+            await self.dispatch(json.loads(payload))
+        except Exception:
+            logger.exception('Lock notification not delivered: %.200s', payload)
+
+    async def dispatch(self, event):
+        event['type'] = 'receive.locks'
+        consumers = list(self.consumers.get(event['item_type'], ()))
+        results = await asyncio.gather(
+            *(consumer.receive_locks(event) for consumer in consumers), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error('Lock update not delivered', exc_info=result)
+
+
+lock_listener = LockListener()
@@ -0,0 +1,94 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .cache import item_type_cache, permission_cache, visibility_cache
+from .models import GroupTypeVisibility, Item
+
+User = get_user_model()
+
+
+def _invalidate(invalidate, *args):
+    """
+    Invalidate now and again once the transaction is committed: a lookup running
+    meanwhile still reads the old rows, and would cache them until they expire
+    """
+    invalidate(*args)
+    transaction.on_commit(lambda: invalidate(*args))
+
+
+@receiver(post_save, sender=GroupTypeVisibility)
+@receiver(post_delete, sender=GroupTypeVisibility)
+def invalidate_group_visibility(sender, instance, **kwargs):
+    _invalidate(visibility_cache.invalidate_group, instance.group_id)
+
+
+@receiver(pre_save, sender=GroupTypeVisibility)
+def invalidate_previous_group_visibility(sender, instance, raw=False, **kwargs):
+    # the group which loses the item type, when moved to another one
+    if raw or instance.pk is None:
+        return
+    previous_group_id = sender.objects.filter(pk=instance.pk).values_list('group_id', flat=True).first()
+    if previous_group_id is not None and previous_group_id != instance.group_id:
+        _invalidate(visibility_cache.invalidate_group, previous_group_id)
+
+
+@receiver(post_delete, sender=Group)
+def invalidate_deleted_group(sender, instance, **kwargs):
+    # memberships are removed without m2m_changed
+    _invalidate(visibility_cache.invalidate_group, instance.id)
+    _invalidate(visibility_cache.invalidate_users)
+    _invalidate(permission_cache.invalidate_users)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_deleted_user(sender, instance, **kwargs):
+    _invalidate(visibility_cache.invalidate_user, instance.id)
+    _invalidate(permission_cache.invalidate_user, instance.id)
+
+
+@receiver(post_save, sender=User)
+def invalidate_saved_user(sender, instance, **kwargs):
+    # eg: is_superuser changed
+    _invalidate(permission_cache.invalidate_user, instance.id)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def invalidate_user_groups(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _invalidate(visibility_cache.invalidate_user, instance.id)
+        _invalidate(permission_cache.invalidate_user, instance.id)
+    elif pk_set is None:
+        # group cleared: members are not known anymore
+        _invalidate(visibility_cache.invalidate_users)
+        _invalidate(permission_cache.invalidate_users)
+    else:
+        for user_id in pk_set:
+            _invalidate(visibility_cache.invalidate_user, user_id)
+            _invalidate(permission_cache.invalidate_user, user_id)
+
+
+@receiver(m2m_changed, sender=User.user_permissions.through)
+def invalidate_user_permissions(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        _invalidate(permission_cache.invalidate_user, instance.id)
+    else:
+        # permission granted to or removed from users
+        _invalidate(permission_cache.invalidate_users)
+
+
+@receiver(m2m_changed, sender=Group.permissions.through)
+def invalidate_group_permissions(sender, instance, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        _invalidate(permission_cache.invalidate_users)
+
+
+@receiver(post_save, sender=Item)
+@receiver(post_delete, sender=Item)
+def invalidate_item_type(sender, instance, **kwargs):
+    item_type_cache.invalidate(instance.id)
@@ -3,12 +3,29 @@ import threading
 from async_generator import async_generator, yield_
 import pytest
 from django.core.management import call_command
+from ..cache import item_type_cache, lock_snapshot_cache, permission_cache, visibility_cache
+from ..events import event_log
+from ..limits import limit_counters, user_buckets
+from ..metrics import metrics
 from .utils import application, websocket_connect_to_asgi, User
 
 
 ConnectionTuple = namedtuple('ConnectionTuple', ['user', 'communicator', 'connected'])
 
 
+@pytest.fixture(autouse=True)
+def clear_ws_lock_caches():
+    # database is rolled back between tests without sending any signal
+    visibility_cache.clear()
+    permission_cache.clear()
+    item_type_cache.clear()
+    lock_snapshot_cache.clear()
+    event_log.clear()
+    user_buckets.clear()
+    limit_counters.clear()
+    metrics.clear()
+
+
 @pytest.fixture(scope='function')
 def django_db_setup_for_sockets(django_db_setup, django_db_blocker):
     print('fixture-sync', threading.get_ident())
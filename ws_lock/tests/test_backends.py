@@ -0,0 +1,289 @@
+import asyncio
+from unittest import mock
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from redis.exceptions import RedisError
+
+try:
+    from channels.testing import ConsumerTestMixin
+except ImportError:
+    class ConsumerTestMixin:
+        pass
+
+from ..backends import MemoryLockBackend, RedisLockBackend, ShardedLockBackend, get_lock_backend
+from ..consumers import ItemLockConsumer
+from ..hashring import HashRing
+from ..models import ItemLock
+from .utils import websocket_connect_to_asgi, User
+
+MEMORY_BACKEND = 'ws_lock.backends.MemoryLockBackend'
+
+
+class TestMemoryBackend(ConsumerTestMixin, TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.USERS = {
+            username: User.objects.get_by_natural_key(username)
+            for username in ['alice', 'bob']
+        }
+
+    def setUp(self):
+        get_lock_backend.cache_clear()
+        self.application = ItemLockConsumer.as_asgi(lock_backend=MEMORY_BACKEND)
+
+    @sync_to_async
+    def _db_locks(self):
+        return list(ItemLock.objects.order_by('id').values_list('item_id', 'user_id', 'locked'))
+
+    async def test_write_behind(self):
+        communicator_baz = websocket_connect_to_asgi(self.application, self.USERS['alice'])
+        connected, _subprotocol = await communicator_baz.connect()
+        self.assertTrue(connected)
+        communicator_bar = websocket_connect_to_asgi(self.application, self.USERS['bob'])
+        connected, _subprotocol = await communicator_bar.connect()
+        self.assertTrue(connected)
+        # item 3 is FOO
+        await communicator_bar.send_json_to({'items': [3]})
+        received_bar = await communicator_bar.receive_json_from()
+        received_baz = await communicator_baz.receive_json_from()
+        assert received_bar == received_baz == [{
+            'user': self.USERS['bob'].id,
+            'item': 3,
+            'locked': True
+        }]
+        # item 3 already locked
+        await communicator_baz.send_json_to({'items': [3]})
+        assert await communicator_baz.receive_nothing()
+
+        backend = get_lock_backend(MEMORY_BACKEND)
+        await backend.flush()
+        assert await self._db_locks() == [(3, self.USERS['bob'].id, True)]
+        acquired = await ItemLock.objects.aget(item_id=3)
+
+        # leave lock
+        await communicator_bar.send_json_to({'items': []})
+        received_baz = await communicator_baz.receive_json_from()
+        assert received_baz == [{
+            'user': self.USERS['bob'].id,
+            'item': 3,
+            'locked': False
+        }]
+        await backend.flush()
+        assert await self._db_locks() == [(3, self.USERS['bob'].id, False)]
+        # time of release
+        assert (await ItemLock.objects.aget(item_id=3)).updated > acquired.updated
+
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+    async def test_write_during_flush(self):
+        backend = MemoryLockBackend()
+        backend.flush_interval = 0
+        started = asyncio.Event()
+        proceed = asyncio.Event()
+        write = backend._write
+
+        async def blocking_write(pending):
+            started.set()
+            await proceed.wait()
+            await sync_to_async(write)(pending)
+
+        # item 3 is FOO, 7 is BAZ
+        with mock.patch('ws_lock.backends.sync_to_async', side_effect=lambda func: blocking_write):
+            await backend.acquire_locks(self.USERS['bob'], [3])
+            await started.wait()
+            # queued while the first batch is written
+            await backend.acquire_locks(self.USERS['alice'], [7])
+            proceed.set()
+            await asyncio.wait_for(backend._flush_task, 1)
+        assert await self._db_locks() == [(3, self.USERS['bob'].id, True), (7, self.USERS['alice'].id, True)]
+
+    async def test_lock_already_held(self):
+        # item 3 is FOO, locked by a connection which is gone
+        await sync_to_async(ItemLock.objects.create)(item_id=3, user=self.USERS['bob'])
+        backend = MemoryLockBackend()
+        assert [lock.item_id for lock in await backend.acquire_locks(self.USERS['bob'], [3])] == [3]
+        assert await backend.acquire_locks(self.USERS['alice'], [3]) == []
+        assert [lock.item_id for lock in await backend.release_locks(self.USERS['bob'], [3])] == [3]
+        await backend.flush()
+        assert await self._db_locks() == [(3, self.USERS['bob'].id, False)]
+
+    async def test_failed_flush(self):
+        backend = MemoryLockBackend()
+        await backend.acquire_locks(self.USERS['bob'], [3])
+        with mock.patch.object(MemoryLockBackend, '_write', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                await backend.flush()
+        assert len(backend.pending) == 1
+        await backend.flush()
+        assert await self._db_locks() == [(3, self.USERS['bob'].id, True)]
+
+
+@override_settings(WS_LOCK_REDIS_PREFIX='ws_lock_test')
+class TestRedisBackend(TestCase):
+    """Runs against fakeredis when installed, otherwise against WS_LOCK_REDIS_URL"""
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    async def _backend(self):
+        try:
+            from fakeredis import FakeAsyncRedis
+        except ImportError:
+            backend = RedisLockBackend()
+        else:
+            backend = RedisLockBackend(client=FakeAsyncRedis())
+        try:
+            await backend.client.ping()
+        except RedisError as exc:
+            self.skipTest(f'Redis is not available: {exc}')
+        await backend.clear()
+        return backend
+
+    @sync_to_async
+    def _db_locks(self):
+        return list(ItemLock.objects.order_by('id').values_list('item_id', 'user_id', 'locked'))
+
+    async def test_change_locks(self):
+        backend = await self._backend()
+        # item 3 is FOO, 5 is BAR, 7 is BAZ: alice cannot see BAR
+        active_locks, _left_locks = await backend.change_locks(self.alice, [3, 5, 7], [])
+        assert [lock.item_id for lock in active_locks] == [3, 7]
+        # locks already held are returned again
+        active_locks, _left_locks = await backend.change_locks(self.alice, [3], [])
+        assert [lock.item_id for lock in active_locks] == [3]
+        active_locks, _left_locks = await backend.change_locks(self.bob, [3, 5], [])
+        assert [lock.item_id for lock in active_locks] == [5]
+        # items of others are not released, both changes are applied at once
+        active_locks, left_locks = await backend.change_locks(self.bob, [4], [3, 5])
+        assert [(lock.item_id, lock.locked) for lock in active_locks] == [(4, True)]
+        assert [(lock.item_id, lock.locked) for lock in left_locks] == [(5, False)]
+
+        left_locks = await backend.leave_locks(self.alice)
+        assert [(lock.item_id, lock.user_id, lock.locked) for lock in left_locks] == [
+            (3, self.alice.id, False), (7, self.alice.id, False),
+        ]
+        assert await backend.leave_locks(self.alice) == []
+
+        await backend.flush()
+        assert await self._db_locks() == [
+            (3, self.alice.id, False),
+            (7, self.alice.id, False),
+            (5, self.bob.id, False),
+            (4, self.bob.id, True),
+        ]
+        await backend.clear()
+
+
+class TestShardedBackend(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    @sync_to_async
+    def _db_locks(self):
+        return sorted(ItemLock.objects.values_list('item_id', 'user_id', 'locked'))
+
+    async def _connect_worker(self, backend):
+        """Connection to a worker using backend, which starts serving its shards"""
+        communicator = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(backend=backend), self.bob)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    def test_hash_ring(self):
+        keys = range(10000)
+        three, four = HashRing(range(3)), HashRing(range(4))
+        assert {three.node(key) for key in keys} == {0, 1, 2}
+        # about a quarter of the keys move to the new node, the others stay
+        moved = [key for key in keys if three.node(key) != four.node(key)]
+        assert 1500 < len(moved) < 3500
+        assert {four.node(key) for key in moved} == {3}
+
+    async def test_forwarded(self):
+        # two workers sharing a channel layer, each owning one shard
+        channel_layer = InMemoryChannelLayer()
+        first = ShardedLockBackend(shards=2, owned=[0], channel_layer=channel_layer)
+        second = ShardedLockBackend(shards=2, owned=[1], channel_layer=channel_layer)
+        communicator = await self._connect_worker(second)
+        # items 3 and 4 are FOO, 7 and 8 are BAZ
+        items = [3, 4, 7, 8]
+        assert {first.shard(item_id) for item_id in items} == {0, 1}
+
+        active_locks, _left_locks = await first.change_locks(self.alice, items, [])
+        assert [lock.item_id for lock in active_locks] == items
+        assert sorted(first.locks) == [i for i in items if first.shard(i) == 0]
+        assert sorted(second.locks) == [i for i in items if first.shard(i) == 1]
+        # locks already held are returned again, from every shard
+        active_locks, _left_locks = await first.change_locks(self.alice, items, [])
+        assert [lock.item_id for lock in active_locks] == items
+        # items are locked for every worker
+        active_locks, _left_locks = await second.change_locks(self.bob, [3, 4, 5], [])
+        assert [lock.item_id for lock in active_locks] == [5]
+        _active_locks, left_locks = await second.change_locks(self.alice, [], [3, 7])
+        assert [(lock.item_id, lock.locked) for lock in left_locks] == [(3, False), (7, False)]
+
+        left_locks = await first.leave_locks(self.alice)
+        assert [lock.item_id for lock in left_locks] == [4, 8]
+        assert list(first.locks.values()) + list(second.locks.values()) == [self.bob.id]
+
+        await first.flush()
+        await second.flush()
+        assert await self._db_locks() == [
+            (3, self.alice.id, False), (4, self.alice.id, False), (5, self.bob.id, True),
+            (7, self.alice.id, False), (8, self.alice.id, False),
+        ]
+        await communicator.disconnect()
+        await first.stop()
+        await second.stop()
+
+    async def test_owner_timeout(self):
+        channel_layer = InMemoryChannelLayer()
+        first = ShardedLockBackend(shards=2, owned=[0], channel_layer=channel_layer)
+        second = ShardedLockBackend(shards=2, owned=[1], channel_layer=channel_layer)
+        first.timeout = 0.01
+        # items 3 and 4 are FOO, 7 and 8 are BAZ
+        item_id = next(i for i in [3, 4, 7, 8] if first.shard(i) == 1)
+        communicator = await self._connect_worker(second)
+        await first.change_locks(self.alice, [item_id], [])
+        await communicator.disconnect()
+        await second.stop()
+        # second worker does not answer anymore
+        _active_locks, left_locks = await first.change_locks(self.alice, [], [item_id])
+        assert [(lock.item_id, lock.locked) for lock in left_locks] == [(item_id, False)]
+        assert await first.change_locks(self.bob, [item_id], []) == ([], [])
+        communicator = await self._connect_worker(second)
+        for _n in range(10):
+            await asyncio.sleep(0.01)
+        # the late acquisition has been undone, the late release stands
+        assert second.locks == {}
+        await second.flush()
+        assert await self._db_locks() == [(item_id, self.alice.id, False), (item_id, self.bob.id, False)]
+        await communicator.disconnect()
+        await first.stop()
+        await second.stop()
+
+    async def test_bad_message(self):
+        channel_layer = InMemoryChannelLayer()
+        first = ShardedLockBackend(shards=2, owned=[0], channel_layer=channel_layer)
+        second = ShardedLockBackend(shards=2, owned=[1], channel_layer=channel_layer)
+        communicator = await self._connect_worker(second)
+        await channel_layer.send(second.shard_channel(1), {'type': 'lock.change'})
+        # items 3 and 4 are FOO, 7 and 8 are BAZ
+        item_id = next(i for i in [3, 4, 7, 8] if first.shard(i) == 1)
+        active_locks, _left_locks = await first.change_locks(self.alice, [item_id], [])
+        assert [lock.item_id for lock in active_locks] == [item_id]
+        await second.flush()
+        await communicator.disconnect()
+        await first.stop()
+        await second.stop()
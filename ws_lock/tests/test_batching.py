@@ -0,0 +1,231 @@
+import asyncio
+from unittest import mock
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase
+from ..backends import GroupCommitLockBackend
+from ..batching import Batcher, GroupCommitWriter
+from ..consumers import ItemLockConsumer
+from ..models import ItemLock
+from .utils import capture_queries, websocket_connect_to_asgi, User
+
+
+class BlockingBatcher(Batcher):
+    window = 0
+
+    def __init__(self):
+        super().__init__()
+        self.started = asyncio.Event()
+        self.proceed = asyncio.Event()
+        self.batches = []
+
+    async def process(self, requests):
+        self.batches.append(requests)
+        self.started.set()
+        await self.proceed.wait()
+        return [request * 2 for request in requests]
+
+
+class TestBatcher(SimpleTestCase):
+    async def test_submit_during_process(self):
+        batcher = BlockingBatcher()
+        first = asyncio.ensure_future(batcher.submit(1))
+        await batcher.started.wait()
+        # the first batch is in flight
+        second = asyncio.ensure_future(batcher.submit(2))
+        await asyncio.sleep(0)
+        batcher.proceed.set()
+        assert await asyncio.wait_for(asyncio.gather(first, second), 1) == [2, 4]
+        assert batcher.batches == [[1], [2]]
+
+    async def test_cancelled(self):
+        batcher = BlockingBatcher()
+        first = asyncio.ensure_future(batcher.submit(1))
+        await batcher.started.wait()
+        second = asyncio.ensure_future(batcher.submit(2))
+        await asyncio.sleep(0)
+        batcher._task.cancel()
+        results = await asyncio.wait_for(asyncio.gather(first, second, return_exceptions=True), 1)
+        assert all(isinstance(result, asyncio.CancelledError) for result in results)
+
+
+class TestBatchedDisconnect(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    async def _connect(self, application, user, items):
+        communicator = websocket_connect_to_asgi(application, user)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        if items:
+            await communicator.send_json_to({'items': items})
+            await communicator.receive_json_from()
+        return communicator
+
+    async def test_merged_release(self):
+        application = ItemLockConsumer.as_asgi(batch_disconnects=True)
+        observer = await self._connect(application, self.alice, [])
+        # items 3 and 4 are FOO
+        communicator_bar = await self._connect(application, self.bob, [3])
+        await observer.receive_json_from()
+        communicator_baz = await self._connect(application, self.alice, [4])
+        await observer.receive_json_from()
+
+        async with capture_queries() as queries:
+            await asyncio.gather(communicator_bar.disconnect(), communicator_baz.disconnect())
+            received = await observer.receive_json_from()
+        assert len(queries) == 1
+        assert received == [
+            {'user': self.bob.id, 'item': 3, 'locked': False},
+            {'user': self.alice.id, 'item': 4, 'locked': False},
+        ]
+        assert await observer.receive_nothing()
+
+        await observer.disconnect()
+
+
+class TestGroupCommit(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    def _summary(self, results):
+        return [
+            ([lock.item_id for lock in acquired], [lock.item_id for lock in released])
+            for acquired, released in results
+        ]
+
+    def test_first_submitted_wins(self):
+        # item 3 and 4 are FOO, 7 is BAZ
+        results = GroupCommitWriter._apply([
+            (self.bob, [3, 4], []),
+            (self.alice, [3, 7], []),
+        ])
+        assert self._summary(results) == [([3, 4], []), ([7], [])]
+
+    def test_release_before_acquire(self):
+        GroupCommitWriter._apply([(self.bob, [3], [])])
+        results = GroupCommitWriter._apply([
+            (self.alice, [3], []),
+            (self.bob, [], [3]),
+        ])
+        assert self._summary(results) == [([3], []), ([], [3])]
+        assert list(ItemLock.objects.filter(locked=True).values_list('item_id', 'user_id')) == [(3, self.alice.id)]
+
+    def test_lock_already_held(self):
+        # item 3 is FOO, locked by a connection of alice which is gone
+        ItemLock.objects.create(item_id=3, user=self.alice)
+        results = GroupCommitWriter._apply([
+            (self.bob, [3], []),
+            (self.alice, [3], []),
+        ])
+        assert self._summary(results) == [([], []), ([3], [])]
+
+    async def test_change_during_commit(self):
+        backend = GroupCommitLockBackend()
+        started = asyncio.Event()
+        proceed = asyncio.Event()
+        process = backend.writer.process
+
+        async def blocking_process(changes):
+            started.set()
+            await proceed.wait()
+            return await process(changes)
+
+        backend.writer.process = blocking_process
+        # item 3 is FOO, 7 is BAZ
+        first = asyncio.ensure_future(backend.change_locks(self.bob, [3], []))
+        await started.wait()
+        second = asyncio.ensure_future(backend.change_locks(self.alice, [7], []))
+        await asyncio.sleep(0)
+        proceed.set()
+        results = await asyncio.wait_for(asyncio.gather(first, second), 1)
+        assert self._summary(results) == [([3], []), ([7], [])]
+
+    async def test_consumers(self):
+        application = ItemLockConsumer.as_asgi(lock_backend='ws_lock.backends.GroupCommitLockBackend')
+        communicator_baz = websocket_connect_to_asgi(application, self.alice)
+        connected, _subprotocol = await communicator_baz.connect()
+        self.assertTrue(connected)
+        communicator_bar = websocket_connect_to_asgi(application, self.bob)
+        connected, _subprotocol = await communicator_bar.connect()
+        self.assertTrue(connected)
+        # both changes are written together, only one of them gets item 3
+        await communicator_bar.send_json_to({'items': [3]})
+        await communicator_baz.send_json_to({'items': [3, 7]})
+        received_bar = await communicator_bar.receive_json_from()
+        winner = received_bar[0]['user']
+        assert winner in (self.alice.id, self.bob.id)
+        assert received_bar == [{'user': winner, 'item': 3, 'locked': True}]
+        received_baz = [await communicator_baz.receive_json_from(), await communicator_baz.receive_json_from()]
+        received_baz = sorted((lock for locks in received_baz for lock in locks), key=lambda lock: lock['item'])
+        assert received_baz == [
+            {'user': winner, 'item': 3, 'locked': True},
+            {'user': self.alice.id, 'item': 7, 'locked': True},
+        ]
+        assert await ItemLock.objects.filter(locked=True).acount() == 2
+
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+
+class TestCoalescing(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+
+    async def test_burst(self):
+        application = ItemLockConsumer.as_asgi(coalesce_window=0.05)
+        communicator = websocket_connect_to_asgi(application, self.alice)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+
+        async with capture_queries() as queries:
+            # items 3 and 4 are FOO, 7 and 8 are BAZ
+            for items in [[3], [3, 4], [4], [4, 8], [8, 7], [7]] * 3:
+                await communicator.send_json_to({'items': items})
+            await communicator.send_json_to({'acquire': [4]})
+            await communicator.send_json_to({'release': [7]})
+            received = await communicator.receive_json_from()
+        assert received == [{'item': 4, 'user': self.alice.id, 'locked': True}]
+        assert await communicator.receive_nothing()
+        # validation then locking
+        assert len(queries) == 2
+        assert [lock.item_id async for lock in ItemLock.objects.all()] == [4]
+
+        await communicator.disconnect()
+        assert [lock.item_id async for lock in ItemLock.objects.filter(locked=True)] == []
+
+    async def test_failed_update(self):
+        application = ItemLockConsumer.as_asgi(coalesce_window=0.01)
+        communicator = websocket_connect_to_asgi(application, self.alice)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        update_locks = ItemLockConsumer._update_locks
+        calls = []
+
+        async def failing_update_locks(consumer, requested):
+            calls.append(requested)
+            if len(calls) == 1:
+                raise DatabaseError
+            return await update_locks(consumer, requested)
+
+        # item 3 is FOO
+        with mock.patch.object(ItemLockConsumer, '_update_locks', failing_update_locks):
+            with self.assertLogs('ws_lock.consumers', 'ERROR'):
+                await communicator.send_json_to({'items': [3]})
+                assert await communicator.receive_json_from() == {'error': 'update_failed'}
+            # requests are still applied after a failure
+            await communicator.send_json_to({'items': [3]})
+            received = await communicator.receive_json_from()
+        assert received == [{'item': 3, 'user': self.alice.id, 'locked': True}]
+
+        await communicator.disconnect()
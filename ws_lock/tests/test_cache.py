@@ -0,0 +1,199 @@
+import time
+from unittest import mock
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import Group, Permission
+from django.test import TestCase
+from ..cache import ItemTypeCache, LockSnapshotCache, item_type_cache, permission_cache, visibility_cache
+from ..consumers import ItemLockConsumer, resolve_connection
+from ..models import GroupTypeVisibility, Item, ItemLock, ItemTypes
+from .utils import capture_queries, websocket_connect_to_asgi, User
+
+
+class TestVisibilityCache(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+
+    def test_cached(self):
+        with self.assertNumQueries(2):
+            assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BAZ}
+        with self.assertNumQueries(0):
+            assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BAZ}
+
+    def test_visibility_changed(self):
+        visibility_cache.visible_types(self.alice)
+        group = self.alice.groups.get()
+        visibility = GroupTypeVisibility.objects.create(group=group, item_type=ItemTypes.BOO)
+        # only the group needs to be reloaded
+        with self.assertNumQueries(1):
+            assert visibility_cache.visible_types(self.alice) == {ItemTypes.BOO, ItemTypes.FOO, ItemTypes.BAZ}
+        visibility.delete()
+        assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BAZ}
+
+    def test_invalidated_on_commit(self):
+        visible_types = visibility_cache.visible_types(self.alice)
+        group = self.alice.groups.get()
+        with self.captureOnCommitCallbacks(execute=True):
+            GroupTypeVisibility.objects.create(group=group, item_type=ItemTypes.BOO)
+            # old rows reloaded by a lookup of another thread before commit
+            visibility_cache.groups[group.id] = (visible_types, time.monotonic())
+        assert visibility_cache.visible_types(self.alice) == {ItemTypes.BOO, ItemTypes.FOO, ItemTypes.BAZ}
+
+    def test_visibility_moved(self):
+        bob = User.objects.get_by_natural_key('bob')
+        assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BAZ}
+        visible_to_bob = visibility_cache.visible_types(bob)
+        visibility = GroupTypeVisibility.objects.get(group=self.alice.groups.get(), item_type=ItemTypes.BAZ)
+        visibility.group = bob.groups.get()
+        visibility.save()
+        assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO}
+        assert visibility_cache.visible_types(bob) == visible_to_bob | {ItemTypes.BAZ}
+
+    def test_expired(self):
+        visibility_cache.visible_types(self.alice)
+        # changed without signals, eg: by another process
+        GroupTypeVisibility.objects.filter(
+            group__user=self.alice, item_type=ItemTypes.BAZ
+        ).update(item_type=ItemTypes.BOO)
+        assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BAZ}
+        with mock.patch('ws_lock.cache.time.monotonic', return_value=time.monotonic() + visibility_cache.ttl):
+            assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BOO}
+
+    def test_user_groups_changed(self):
+        visibility_cache.visible_types(self.alice)
+        other_group = Group.objects.get(pk=2)
+        self.alice.groups.add(other_group)
+        assert visibility_cache.visible_types(self.alice) == set(ItemTypes.values)
+        other_group.user_set.remove(self.alice)
+        assert visibility_cache.visible_types(self.alice) == {ItemTypes.FOO, ItemTypes.BAZ}
+        self.alice.groups.clear()
+        assert visibility_cache.visible_types(self.alice) == set()
+
+
+class TestConnectionCache(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.david = User.objects.get_by_natural_key('david')
+
+    async def _connect(self, user):
+        communicator = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(), user)
+        connected, _subprotocol = await communicator.connect()
+        return communicator, connected
+
+    async def test_connect_queries(self):
+        async with capture_queries() as queries:
+            communicator, connected = await self._connect(self.alice)
+        assert connected
+        # user and group permissions, groups and their visible types, then active locks
+        assert len(queries) == 5
+        async with capture_queries() as queries:
+            other, connected = await self._connect(self.alice)
+        assert connected
+        assert len(queries) == 0
+        await other.disconnect()
+        await communicator.disconnect()
+
+        async with capture_queries() as queries:
+            communicator, connected = await self._connect(self.david)
+        assert not connected
+        # visible types are not needed
+        assert len(queries) == 2
+
+    def test_permissions_changed(self):
+        assert async_to_sync(resolve_connection)(self.david) == (False, frozenset())
+        self.david.user_permissions.set(self.alice.user_permissions.all())
+        self.david.groups.add(self.alice.groups.get())
+        # permissions cached on the instance are not used
+        self.david = User.objects.get(pk=self.david.pk)
+        with self.assertNumQueries(4):
+            assert async_to_sync(resolve_connection)(self.david) == (True, {ItemTypes.FOO, ItemTypes.BAZ})
+        with self.assertNumQueries(0):
+            async_to_sync(resolve_connection)(self.david)
+        self.david.user_permissions.remove(Permission.objects.get(codename='view_item'))
+        self.david = User.objects.get(pk=self.david.pk)
+        assert async_to_sync(resolve_connection)(self.david) == (False, frozenset())
+
+    def test_permissions_invalidated_on_commit(self):
+        assert async_to_sync(resolve_connection)(self.alice)[0]
+        with self.captureOnCommitCallbacks(execute=True):
+            self.alice.user_permissions.clear()
+            self.alice.groups.clear()
+            # old rows reloaded by a lookup of another thread before commit
+            permission_cache.update(self.alice.id, True, permission_cache.generation)
+        self.alice = User.objects.get(pk=self.alice.pk)
+        assert async_to_sync(resolve_connection)(self.alice) == (False, frozenset())
+
+    def test_permissions_expired(self):
+        assert async_to_sync(resolve_connection)(self.alice) == (True, {ItemTypes.FOO, ItemTypes.BAZ})
+        # revoked without signals, eg: by another process
+        User.user_permissions.through.objects.filter(user=self.alice).delete()
+        Group.permissions.through.objects.filter(group__user=self.alice).delete()
+        self.alice = User.objects.get(pk=self.alice.pk)
+        assert async_to_sync(resolve_connection)(self.alice)[0]
+        with mock.patch('ws_lock.cache.time.monotonic', return_value=time.monotonic() + permission_cache.ttl):
+            assert async_to_sync(resolve_connection)(self.alice) == (False, frozenset())
+
+
+class TestItemTypeCache(TestCase):
+    fixtures = ['initial_setup']
+
+    def test_cached(self):
+        cache = ItemTypeCache(maxsize=10)
+        with self.assertNumQueries(1):
+            assert cache.item_types([3, 7, 100]) == {3: ItemTypes.FOO, 7: ItemTypes.BAZ}
+        with self.assertNumQueries(0):
+            assert cache.item_types([3, 7]) == {3: ItemTypes.FOO, 7: ItemTypes.BAZ}
+
+    def test_eviction(self):
+        cache = ItemTypeCache(maxsize=2)
+        cache.item_types([1, 3])
+        # 1 is the most recently used, 3 gets evicted
+        cache.item_types([1])
+        cache.item_types([5])
+        assert len(cache) == 2
+        assert cache.cached_item_types([1, 3, 5]) == ({1: ItemTypes.BOO, 5: ItemTypes.BAR}, [3])
+
+    def test_item_changed(self):
+        assert item_type_cache.item_types([3]) == {3: ItemTypes.FOO}
+        Item.objects.filter(pk=3).update(item_type=ItemTypes.BAR)
+        Item.objects.get(pk=3).save()
+        assert item_type_cache.item_types([3]) == {3: ItemTypes.BAR}
+
+
+class TestLockSnapshotCache(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    def test_applied_once(self):
+        cache = LockSnapshotCache(ttl=60)
+        # item 3 is FOO
+        assert async_to_sync(cache.snapshot)([ItemTypes.FOO]) == []
+        locked = [{'item': 3, 'user': self.bob.id, 'locked': True}]
+        cache.apply(ItemTypes.FOO, locked, 'first')
+        cache.apply(ItemTypes.FOO, [{'item': 3, 'user': self.bob.id, 'locked': False}], 'second')
+        # same update delivered to another consumer
+        cache.apply(ItemTypes.FOO, locked, 'first')
+        with self.assertNumQueries(0):
+            assert async_to_sync(cache.snapshot)([ItemTypes.FOO]) == []
+
+    def test_update_during_load(self):
+        cache = LockSnapshotCache(ttl=60)
+        query = ItemLock.objects.filter
+
+        def filter(*args, **kwargs):
+            cache.apply(ItemTypes.BAR, [], 'other')
+            return query(*args, **kwargs)
+
+        # only the updated type is not stored
+        with mock.patch.object(ItemLock.objects, 'filter', filter):
+            async_to_sync(cache.snapshot)([ItemTypes.FOO, ItemTypes.BAR])
+        assert ItemTypes.FOO in cache.locks
+        assert ItemTypes.BAR not in cache.locks
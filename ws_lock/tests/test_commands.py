@@ -0,0 +1,31 @@
+import json
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+from ..models import ItemLock
+from .utils import User
+
+
+class TestCompactLocks(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    def test_compact(self):
+        old = timezone.now() - timedelta(days=10)
+        ItemLock.objects.bulk_create([ItemLock(item_id=item_id, user=self.bob, locked=False) for item_id in range(1, 6)])
+        ItemLock.objects.filter(item_id__in=[1, 2, 3]).update(updated=old)
+        ItemLock.objects.create(item_id=4, user=self.bob)
+        ItemLock.objects.filter(locked=True).update(updated=old)
+
+        with tempfile.NamedTemporaryFile('r') as archive:
+            call_command('compact_locks', retention=5, batch_size=2, archive=archive.name, stdout=StringIO())
+            assert sorted(json.loads(line)['item_id'] for line in archive) == [1, 2, 3]
+
+        # recent history and active locks are kept
+        assert sorted(ItemLock.objects.values_list('item_id', 'locked')) == [(4, False), (4, True), (5, False)]
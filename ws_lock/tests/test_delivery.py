@@ -0,0 +1,264 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.test import TestCase, override_settings
+from ..consumers import ItemLockConsumer
+from ..events import EventLog, type_group, type_groups
+from ..limits import limit_counters
+from ..wire import PackedFormat, SequencedJSONFormat, SequencedPackedFormat
+from .utils import websocket_connect_to_asgi, User
+
+
+class TestDelivery(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    async def _connect(self, application, user, **kwargs):
+        communicator = websocket_connect_to_asgi(application, user, **kwargs)
+        connected, subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator, subprotocol
+
+    async def test_preencoded(self):
+        application = ItemLockConsumer.as_asgi(preencode_locks=True)
+        communicator_baz, _subprotocol = await self._connect(application, self.alice)
+        communicator_bar, _subprotocol = await self._connect(application, self.bob)
+        # item 3 is FOO
+        await communicator_bar.send_json_to({'items': [3]})
+        received_bar = await communicator_bar.receive_from()
+        received_baz = await communicator_baz.receive_from()
+        assert received_bar == received_baz == '[{"item": 3, "user": %d, "locked": true}]' % self.bob.id
+
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+    async def test_packed(self):
+        application = ItemLockConsumer.as_asgi()
+        communicator_baz, subprotocol = await self._connect(
+            application, self.alice, subprotocols=['unknown', PackedFormat.subprotocol]
+        )
+        assert subprotocol == PackedFormat.subprotocol
+        communicator_bar, subprotocol = await self._connect(application, self.bob)
+        assert subprotocol is None
+        # item 3 and 4 are FOO
+        await communicator_bar.send_json_to({'items': [3, 4]})
+        received_bar = await communicator_bar.receive_json_from()
+        received_baz = await communicator_baz.receive_from()
+        assert isinstance(received_baz, bytes)
+        assert PackedFormat.decode(received_baz) == received_bar == [
+            {'item': 3, 'user': self.bob.id, 'locked': True},
+            {'item': 4, 'user': self.bob.id, 'locked': True},
+        ]
+
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+    async def test_snapshot(self):
+        application = ItemLockConsumer.as_asgi()
+        communicator_bar, _subprotocol = await self._connect(application, self.bob)
+        # item 3 is FOO, 5 is BAR
+        await communicator_bar.send_json_to({'items': [3, 5]})
+        await communicator_bar.receive_json_from()
+        await communicator_bar.receive_json_from()
+
+        communicator_baz, _subprotocol = await self._connect(application, self.alice)
+        assert await communicator_baz.receive_json_from() == [{'item': 3, 'user': self.bob.id, 'locked': True}]
+        assert await communicator_baz.receive_nothing()
+
+        # snapshot is kept up to date by lock updates
+        await communicator_bar.send_json_to({'items': [5]})
+        await communicator_baz.receive_json_from()
+        other_baz, _subprotocol = await self._connect(application, self.alice)
+        assert await other_baz.receive_nothing()
+
+        await other_baz.disconnect()
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+    @override_settings(WS_LOCK_GROUP_SHARDS={2: 4})
+    async def test_group_shards(self):
+        assert type_groups(2) == ['type-2-0', 'type-2-1', 'type-2-2', 'type-2-3']
+        assert type_groups(4) == ['type-4']
+        application = ItemLockConsumer.as_asgi()
+        communicator_bar, _subprotocol = await self._connect(application, self.bob)
+        communicators = [(await self._connect(application, self.alice))[0] for _n in range(8)]
+        groups = get_channel_layer().groups
+        # consumers are spread over the shards of the type
+        assert sum(len(groups.get(group, ())) for group in type_groups(2)) == 9
+        assert len([group for group in type_groups(2) if groups.get(group)]) > 1
+        assert len(groups['type-4']) == 8
+
+        # item 3 is FOO
+        await communicator_bar.send_json_to({'items': [3]})
+        expected = [{'item': 3, 'user': self.bob.id, 'locked': True}]
+        assert await communicator_bar.receive_json_from() == expected
+        for communicator in communicators:
+            assert await communicator.receive_json_from() == expected
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        await communicator_bar.disconnect()
+
+    def test_event_log(self):
+        log = EventLog(2)
+        log.subscribe([1])
+        assert log.receive(1, 'a', ['A']) == 1
+        # every consumer receives the same update
+        assert log.receive(1, 'a', ['A']) == 1
+        assert log.receive(1, 'b', ['B']) == 2
+        assert log.since(1, 0) == [(1, ['A']), (2, ['B'])]
+        assert log.since(1, 2) == []
+        assert log.receive(1, 'c', ['C']) == 3
+        # oldest update is not kept anymore
+        assert log.since(1, 0) is None
+        assert log.since(1, 1) == [(2, ['B']), (3, ['C'])]
+        # updates are missed while nobody listens
+        log.unsubscribe([1])
+        assert log.since(1, 3) is None
+        assert log.since(1, 4) == []
+        assert log.since(1, 5) is None
+
+    async def test_resume(self):
+        application = ItemLockConsumer.as_asgi()
+        communicator_bar, _subprotocol = await self._connect(application, self.bob)
+        communicator_baz, subprotocol = await self._connect(
+            application, self.alice, subprotocols=[SequencedJSONFormat.subprotocol]
+        )
+        assert subprotocol == SequencedJSONFormat.subprotocol
+        # nothing is sent until the client resumes
+        assert await communicator_baz.receive_nothing()
+        await communicator_baz.send_json_to({'resume': {}})
+        snapshot = await communicator_baz.receive_json_from()
+        epoch = snapshot['epoch']
+        assert snapshot == {'epoch': epoch, 'seq': {'2': 0, '4': 0}, 'snapshot': True, 'locks': []}
+        # keeps listening to BAZ updates
+        packed_baz, _subprotocol = await self._connect(
+            application, self.alice, subprotocols=[SequencedPackedFormat.subprotocol]
+        )
+
+        # item 3 and 4 are FOO
+        await communicator_bar.send_json_to({'items': [3]})
+        await communicator_bar.receive_json_from()
+        await packed_baz.receive_from()
+        assert await communicator_baz.receive_json_from() == {
+            'epoch': epoch, 'seq': {'2': 1}, 'snapshot': False,
+            'locks': [{'item': 3, 'user': self.bob.id, 'locked': True}],
+        }
+        await communicator_baz.disconnect()
+
+        await communicator_bar.send_json_to({'items': [3, 4]})
+        await communicator_bar.receive_json_from()
+        await packed_baz.receive_from()
+        # only the missed update is sent
+        communicator_baz, _subprotocol = await self._connect(
+            application, self.alice, subprotocols=[SequencedJSONFormat.subprotocol]
+        )
+        await communicator_baz.send_json_to({'resume': {'epoch': epoch, 'seq': {'2': 1, '4': 0}}})
+        assert await communicator_baz.receive_json_from() == {
+            'epoch': epoch, 'seq': {'2': 2}, 'snapshot': False,
+            'locks': [{'item': 4, 'user': self.bob.id, 'locked': True}],
+        }
+        assert await communicator_baz.receive_nothing()
+        await communicator_baz.disconnect()
+        await packed_baz.disconnect()
+
+        # BAZ updates may have been missed while nobody could see them
+        packed_baz, _subprotocol = await self._connect(
+            application, self.alice, subprotocols=[SequencedPackedFormat.subprotocol]
+        )
+        await packed_baz.send_json_to({'resume': {'epoch': epoch, 'seq': {'2': 2, '4': 0}}})
+        # as are any updates of another epoch
+        await packed_baz.send_json_to({'resume': {'epoch': epoch + 1, 'seq': {'2': 2, '4': 1}}})
+        for _n in range(2):
+            assert SequencedPackedFormat.decode(await packed_baz.receive_from()) == {
+                'epoch': epoch, 'seq': {2: 2, 4: 1}, 'snapshot': True, 'locks': [
+                    {'item': 3, 'user': self.bob.id, 'locked': True},
+                    {'item': 4, 'user': self.bob.id, 'locked': True},
+                ],
+            }
+
+        await packed_baz.disconnect()
+        await communicator_bar.disconnect()
+
+    async def test_merged(self):
+        application = ItemLockConsumer.as_asgi(merge_events=True)
+        communicator_baz, _subprotocol = await self._connect(application, self.alice)
+        sequenced_baz, _subprotocol = await self._connect(
+            application, self.alice, subprotocols=[SequencedJSONFormat.subprotocol]
+        )
+        communicator_bar, _subprotocol = await self._connect(application, self.bob)
+        # item 7 is BAZ, item 3 is FOO
+        await communicator_baz.send_json_to({'items': [3, 7]})
+        assert await communicator_bar.receive_json_from() == [{'item': 3, 'user': self.alice.id, 'locked': True}]
+        assert await communicator_baz.receive_json_from() == [
+            {'item': 3, 'user': self.alice.id, 'locked': True},
+            {'item': 7, 'user': self.alice.id, 'locked': True},
+        ]
+        assert await communicator_baz.receive_nothing()
+        received = await sequenced_baz.receive_json_from()
+        assert received['seq'] == {'2': 1, '4': 1}
+        assert sorted(lock['item'] for lock in received['locks']) == [3, 7]
+
+        # updates of a single type are sent as they are
+        await communicator_baz.send_json_to({'items': [7]})
+        assert await communicator_baz.receive_json_from() == [{'item': 3, 'user': self.alice.id, 'locked': False}]
+
+        # a part which never arrives is not waited for
+        payload = [{'item': 4, 'user': self.bob.id, 'locked': True}]
+        await get_channel_layer().group_send(type_group(2), {
+            'type': 'receive.locks', 'item_type': 2, 'id': 'lost:2', 'action': 'lost', 'parts': [2, 4], 'data': payload,
+        })
+        assert await communicator_baz.receive_json_from() == payload
+
+        await sequenced_baz.disconnect()
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+
+class SlowConsumer(ItemLockConsumer):
+
+    async def send_lock_update(self, *args, **kwargs):
+        await asyncio.sleep(0.1)
+        await super().send_lock_update(*args, **kwargs)
+
+
+class TestOutbox(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    async def _lock_items(self, outbox_size):
+        communicator_baz = websocket_connect_to_asgi(SlowConsumer.as_asgi(outbox_size=outbox_size), self.alice)
+        await communicator_baz.connect()
+        communicator_bar = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(), self.bob)
+        await communicator_bar.connect()
+        # items 3 and 4 are FOO
+        for items in [[3], [3, 4], [4]]:
+            await communicator_bar.send_json_to({'items': items})
+            await communicator_bar.receive_json_from()
+        return communicator_baz, communicator_bar
+
+    async def test_merged(self):
+        communicator_baz, communicator_bar = await self._lock_items(10)
+        assert await communicator_baz.receive_json_from() == [{'item': 3, 'user': self.bob.id, 'locked': True}]
+        # pending updates were merged
+        assert await communicator_baz.receive_json_from() == [
+            {'item': 4, 'user': self.bob.id, 'locked': True},
+            {'item': 3, 'user': self.bob.id, 'locked': False},
+        ]
+        assert await communicator_baz.receive_nothing()
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
+
+    async def test_lagging(self):
+        communicator_baz, communicator_bar = await self._lock_items(1)
+        assert await communicator_baz.receive_output() == {'type': 'websocket.close', 'code': 1013}
+        assert limit_counters == {'lagging': 1}
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
@@ -0,0 +1,92 @@
+import asyncio
+from datetime import timedelta
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from ..leases import LeaseKeeper, lease_keeper
+from ..models import ItemLock
+from .utils import application, websocket_connect_to_asgi, User
+
+
+@override_settings(WS_LOCK_LEASE_SECONDS=30)
+class TestLeases(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    async def test_lease_extended(self):
+        communicator = websocket_connect_to_asgi(application, self.alice)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        # item 7 is BAZ
+        await communicator.send_json_to({'items': [7]})
+        await communicator.receive_json_from()
+        lock = await ItemLock.objects.aget(item_id=7, locked=True)
+        assert lock.expires > timezone.now() + timedelta(seconds=25)
+
+        await ItemLock.objects.filter(pk=lock.pk).aupdate(expires=timezone.now() + timedelta(seconds=1))
+        await lease_keeper.heartbeat()
+        await lease_keeper.reap()
+        lock = await ItemLock.objects.aget(pk=lock.pk)
+        assert lock.locked
+        assert lock.expires > timezone.now() + timedelta(seconds=25)
+
+        await communicator.disconnect()
+
+    async def test_no_lease_kept(self):
+        # lock of item 7 (BAZ) written by a backend without leases
+        await sync_to_async(ItemLock.objects.create)(item_id=7, user=self.alice)
+
+        class Consumer:
+            held_items = {7}
+
+        consumer = Consumer()
+        lease_keeper.consumers.add(consumer)
+        await lease_keeper.heartbeat()
+        lease_keeper.consumers.discard(consumer)
+        assert (await ItemLock.objects.aget(item_id=7)).expires is None
+
+    async def test_expired_released(self):
+        communicator = websocket_connect_to_asgi(application, self.alice)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        # lock of item 3 (FOO) left behind by a dead worker
+        await sync_to_async(ItemLock.objects.create)(
+            item_id=3, user=self.bob, expires=timezone.now() - timedelta(seconds=1)
+        )
+        await lease_keeper.reap()
+        assert await communicator.receive_json_from() == [{
+            'user': self.bob.id,
+            'item': 3,
+            'locked': False
+        }]
+        assert not await ItemLock.objects.filter(locked=True).aexists()
+
+        await communicator.disconnect()
+
+    @override_settings(WS_LOCK_LEASE_SECONDS=0.03)
+    async def test_survives_errors(self):
+        class Consumer:
+            held_items = {7}
+
+        keeper = LeaseKeeper()
+        calls = []
+
+        async def heartbeat():
+            calls.append(None)
+            if len(calls) == 1:
+                raise DatabaseError
+
+        consumer = Consumer()
+        with mock.patch.object(keeper, 'heartbeat', heartbeat), mock.patch.object(keeper, 'reap', mock.AsyncMock()):
+            keeper.register(consumer)
+            while len(calls) < 2 and not keeper._task.done():
+                await asyncio.sleep(0.01)
+            assert not keeper._task.done()
+            keeper.unregister(consumer)
+        assert len(calls) >= 2
@@ -0,0 +1,73 @@
+from unittest import mock
+from django.test import SimpleTestCase, TestCase
+from ..consumers import ItemLockConsumer
+from ..limits import TokenBucket, limit_counters
+from ..models import ItemLock
+from .utils import websocket_connect_to_asgi, User
+
+
+class TestTokenBucket(SimpleTestCase):
+
+    def test_consume(self):
+        with mock.patch('ws_lock.limits.time.monotonic', return_value=100):
+            bucket = TokenBucket(2, 3)
+            assert [bucket.consume() for _n in range(4)] == [True, True, True, False]
+        with mock.patch('ws_lock.limits.time.monotonic', return_value=101):
+            assert [bucket.consume() for _n in range(3)] == [True, True, False]
+        # never more than burst
+        with mock.patch('ws_lock.limits.time.monotonic', return_value=200):
+            assert bucket.consume(3)
+            assert not bucket.consume()
+
+
+class TestLimits(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+
+    async def _connect(self, application):
+        communicator = websocket_connect_to_asgi(application, self.alice)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_rate_limit(self):
+        application = ItemLockConsumer.as_asgi(rate_limit=(0.01, 2))
+        communicator = await self._connect(application)
+        # items 3 and 4 are FOO
+        await communicator.send_json_to({'items': [3]})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'items': [4]})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'items': []})
+        assert await communicator.receive_json_from() == {'error': 'throttled'}
+        assert [lock.item_id async for lock in ItemLock.objects.filter(locked=True)] == [4]
+        assert limit_counters == {'throttled': 1}
+        await communicator.disconnect()
+
+    async def test_user_rate_limit(self):
+        application = ItemLockConsumer.as_asgi(user_rate_limit=(0.01, 1), limit_action='close')
+        communicator = await self._connect(application)
+        other = await self._connect(application)
+        await communicator.send_json_to({'items': [3]})
+        await communicator.receive_json_from()
+        await other.receive_json_from()
+        # bucket is shared by connections of the user
+        await other.send_json_to({'items': [4]})
+        assert (await other.receive_output())['type'] == 'websocket.close'
+        assert limit_counters == {'throttled': 1, 'closed': 1}
+        await communicator.disconnect()
+
+    async def test_max_items(self):
+        application = ItemLockConsumer.as_asgi(max_items=2)
+        communicator = await self._connect(application)
+        await communicator.send_json_to({'items': [3, 4, 7]})
+        assert await communicator.receive_json_from() == {'error': 'too_many_items'}
+        await communicator.send_json_to({'items': [3, 4]})
+        await communicator.receive_json_from()
+        await communicator.send_json_to({'acquire': [7]})
+        assert await communicator.receive_json_from() == {'error': 'too_many_items'}
+        assert limit_counters == {'too_many_items': 2}
+        await communicator.disconnect()
@@ -0,0 +1,92 @@
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from ..consumers import ItemLockConsumer
+from ..limits import limit_counters
+from ..metrics import Metrics, metrics
+from .utils import websocket_connect_to_asgi, User
+
+
+class TestMetrics(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.david = User.objects.get_by_natural_key('david')
+
+    def setUp(self):
+        metrics.enabled = True
+
+    def tearDown(self):
+        metrics.enabled = False
+
+    def test_disabled(self):
+        disabled = Metrics(False)
+        with disabled.timer('update_locks'):
+            disabled.inc('lock_requests')
+        assert disabled.histograms['update_locks'].count == 0
+        assert not disabled.counters
+
+    async def test_phases(self):
+        communicator = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(), self.alice)
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        # item 3 is FOO
+        await communicator.send_json_to({'items': [3]})
+        await communicator.receive_json_from()
+        await communicator.disconnect()
+        rejected = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(), self.david)
+        connected, _subprotocol = await rejected.connect()
+        self.assertFalse(connected)
+
+        assert {phase: histogram.count for phase, histogram in metrics.histograms.items()} == {
+            'connect_authorization': 2,
+            'group_resolution': 2,
+            'update_locks': 1,
+            'send_locks': 2,
+            'disconnect_release': 1,
+        }
+        assert metrics.counters == {
+            'connections_accepted': 1,
+            'connections_rejected': 1,
+            'lock_requests': 1,
+            'updates_received': 1,
+            'disconnections': 1,
+        }
+
+    def test_view(self):
+        metrics.histograms['update_locks'].observe(0.003)
+        metrics.histograms['update_locks'].observe(20)
+        metrics.inc('lock_requests', 2)
+        limit_counters['throttled'] += 1
+        response = self.client.get(reverse('metrics'))
+        assert response.status_code == 200
+        assert response['Content-Type'].startswith('text/plain; version=0.0.4')
+        lines = response.content.decode().splitlines()
+        assert '# TYPE ws_lock_phase_seconds histogram' in lines
+        assert 'ws_lock_phase_seconds_bucket{phase="update_locks",le="0.0025"} 0' in lines
+        assert 'ws_lock_phase_seconds_bucket{phase="update_locks",le="0.005"} 1' in lines
+        assert 'ws_lock_phase_seconds_bucket{phase="update_locks",le="10"} 1' in lines
+        assert 'ws_lock_phase_seconds_bucket{phase="update_locks",le="+Inf"} 2' in lines
+        assert 'ws_lock_phase_seconds_count{phase="update_locks"} 2' in lines
+        assert 'ws_lock_events_total{event="lock_requests"} 2' in lines
+        assert 'ws_lock_limit_events_total{reason="throttled"} 1' in lines
+
+    def test_view_disabled(self):
+        metrics.enabled = False
+        response = self.client.get(reverse('metrics'))
+        assert response.status_code == 404
+
+    @override_settings(WS_LOCK_METRICS_ALLOWED_IPS=[])
+    def test_view_forbidden(self):
+        response = self.client.get(reverse('metrics'))
+        assert response.status_code == 403
+        self.alice.is_staff = True
+        self.alice.save()
+        self.client.force_login(self.alice)
+        response = self.client.get(reverse('metrics'))
+        assert response.status_code == 200
+
+    def test_view_remote_address(self):
+        response = self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.7')
+        assert response.status_code == 403
@@ -0,0 +1,39 @@
+from django.db import IntegrityError
+from django.test import TestCase
+from ..models import ItemLock
+from .utils import User
+
+
+class TestItemLockAcquire(TestCase):
+    fixtures = ['initial_setup']
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.get_by_natural_key('alice')
+        cls.bob = User.objects.get_by_natural_key('bob')
+
+    def test_acquire(self):
+        with self.assertNumQueries(1):
+            locks = ItemLock.objects.acquire(self.bob, [3, 4])
+        assert [(lock.item_id, lock.user_id, lock.locked) for lock in locks] == [
+            (3, self.bob.id, True),
+            (4, self.bob.id, True),
+        ]
+        assert all(lock.pk for lock in locks)
+
+    def test_acquire_conflict(self):
+        ItemLock.objects.acquire(self.bob, [3])
+        locks = ItemLock.objects.acquire(self.alice, [3, 7])
+        assert [lock.item_id for lock in locks] == [7]
+        assert list(ItemLock.objects.filter(item_id=3).values_list('user_id', 'locked')) == [(self.bob.id, True)]
+
+    def test_acquire_released(self):
+        ItemLock.objects.acquire(self.bob, [3])
+        ItemLock.objects.update(locked=False)
+        locks = ItemLock.objects.acquire(self.alice, [3])
+        assert [(lock.item_id, lock.user_id) for lock in locks] == [(3, self.alice.id)]
+
+    def test_single_active_lock(self):
+        ItemLock.objects.create(item_id=3, user=self.bob)
+        with self.assertRaises(IntegrityError):
+            ItemLock.objects.create(item_id=3, user=self.alice)
@@ -0,0 +1,75 @@
+import json
+from unittest import skipUnless
+from django.db import connection
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from ..consumers import ItemLockConsumer
+from ..pgnotify import MAX_PAYLOAD, LockListener, _payloads
+from .utils import websocket_connect_to_asgi, User
+
+
+class FakeConsumer:
+
+    def __init__(self, visible_types):
+        self.visible_types = visible_types
+        self.received = []
+
+    async def receive_locks(self, event):
+        self.received.append(event['data'])
+
+
+class TestLockListener(SimpleTestCase):
+
+    def test_large_payload(self):
+        data = [{'item': item_id, 'user': 1, 'locked': True} for item_id in range(1000)]
+        event = {'type': 'receive.locks', 'item_type': 2, 'id': 'a:2', 'action': 'a', 'parts': [2, 4], 'data': data}
+        payloads = _payloads(event)
+        assert len(payloads) > 1
+        assert all(len(payload.encode()) <= MAX_PAYLOAD for payload in payloads)
+        events = [json.loads(payload) for payload in payloads]
+        assert [lock for event in events for lock in event['data']] == data
+        assert len({event['id'] for event in events}) == len(events)
+        assert all(event['parts'] == [2] for event in events)
+
+    async def test_dispatch(self):
+        listener = LockListener()
+        foo, baz = FakeConsumer({2}), FakeConsumer({4})
+        # no connection is opened until run() is awaited
+        listener.consumers[2].add(foo)
+        listener.consumers[4].add(baz)
+        await listener.dispatch({'item_type': 2, 'id': 'a:2', 'action': 'a', 'parts': [2], 'data': ['FOO']})
+        assert foo.received == [['FOO']]
+        assert baz.received == []
+
+    async def test_bad_notification(self):
+        listener = LockListener()
+        foo = FakeConsumer({2})
+        listener.consumers[2].add(foo)
+        with self.assertLogs('ws_lock.pgnotify', 'ERROR'):
+            await listener.receive('{not json')
+            await listener.receive('{"data": ["FOO"]}')
+        await listener.receive('{"item_type": 2, "id": "a:2", "action": "a", "parts": [2], "data": ["FOO"]}')
+        assert foo.received == [['FOO']]
+
+
+@skipUnless(connection.vendor == 'postgresql', 'LISTEN/NOTIFY needs PostgreSQL')
+@override_settings(WS_LOCK_PG_NOTIFY=True)
+class TestNotify(TransactionTestCase):
+    # notifications are only delivered once committed
+    fixtures = ['initial_setup']
+
+    async def test_notify(self):
+        alice = await User.objects.aget(username='alice')
+        bob = await User.objects.aget(username='bob')
+        communicator_baz = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(), alice)
+        connected, _subprotocol = await communicator_baz.connect()
+        self.assertTrue(connected)
+        communicator_bar = websocket_connect_to_asgi(ItemLockConsumer.as_asgi(), bob)
+        connected, _subprotocol = await communicator_bar.connect()
+        self.assertTrue(connected)
+        # item 3 is FOO
+        await communicator_bar.send_json_to({'items': [3]})
+        expected = [{'item': 3, 'user': bob.id, 'locked': True}]
+        assert await communicator_bar.receive_json_from(timeout=5) == expected
+        assert await communicator_baz.receive_json_from(timeout=5) == expected
+        await communicator_baz.disconnect()
+        await communicator_bar.disconnect()
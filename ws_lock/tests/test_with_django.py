@@ -8,8 +8,8 @@ except ImportError:
     class ConsumerTestMixin:
         pass
 
-from ..models import Item
-from .utils import application, websocket_connect_to_asgi, User
+from ..models import Item, ItemLock
+from .utils import application, capture_queries, websocket_connect_to_asgi, User
 
 
 class TestLocks(ConsumerTestMixin, TestCase):
@@ -173,6 +173,102 @@ class TestLocks(ConsumerTestMixin, TestCase):
         await communicator_baz.disconnect()
         await communicator_bar.disconnect()
 
+    async def test_unchanged_items(self):
+        communicator_bar = websocket_connect_to_asgi(application, self.USERS['bob'])
+        connected, _subprotocol = await communicator_bar.connect()
+        self.assertTrue(connected)
+        # item 3 is FOO, item 5 is BAR
+        await communicator_bar.send_json_to({'items': [3]})
+        await communicator_bar.receive_json_from()
+        # same selection again does not reach database
+        async with capture_queries() as queries:
+            await communicator_bar.send_json_to({'items': [3]})
+            assert await communicator_bar.receive_nothing()
+        assert len(queries) == 0
+        # only the added item is sent
+        await communicator_bar.send_json_to({'items': [3, 5]})
+        received_bar = await communicator_bar.receive_json_from()
+        assert received_bar == [{
+            'user': self.USERS['bob'].id,
+            'item': 5,
+            'locked': True
+        }]
+
+        await communicator_bar.disconnect()
+
+    async def test_acquire_release(self):
+        communicator_baz = websocket_connect_to_asgi(application, self.USERS['alice'])
+        connected, _subprotocol = await communicator_baz.connect()
+        self.assertTrue(connected)
+        # item 3 and 4 are FOO
+        await communicator_baz.send_json_to({'acquire': [3]})
+        assert await communicator_baz.receive_json_from() == [{
+            'user': self.USERS['alice'].id,
+            'item': 3,
+            'locked': True
+        }]
+        await communicator_baz.send_json_to({'acquire': [4], 'release': [3]})
+        assert await communicator_baz.receive_json_from() == [
+            {'user': self.USERS['alice'].id, 'item': 4, 'locked': True},
+            {'user': self.USERS['alice'].id, 'item': 3, 'locked': False},
+        ]
+        # unchanged locks are not touched
+        async with capture_queries() as queries:
+            await communicator_baz.send_json_to({'acquire': [4], 'release': [3]})
+            assert await communicator_baz.receive_nothing()
+        assert len(queries) == 0
+        # full set still works
+        await communicator_baz.send_json_to({'items': []})
+        assert await communicator_baz.receive_json_from() == [{
+            'user': self.USERS['alice'].id,
+            'item': 4,
+            'locked': False
+        }]
+
+        await communicator_baz.disconnect()
+
+    async def test_lock_of_earlier_connection(self):
+        # item 3 is FOO, locked by a connection which is gone
+        await sync_to_async(ItemLock.objects.create)(item_id=3, user=self.USERS['alice'])
+        communicator = websocket_connect_to_asgi(application, self.USERS['alice'])
+        connected, _subprotocol = await communicator.connect()
+        self.assertTrue(connected)
+        lock = {'user': self.USERS['alice'].id, 'item': 3, 'locked': True}
+        assert await communicator.receive_json_from() == [lock]
+        # the lock is taken over by the connection, then released
+        await communicator.send_json_to({'items': [3]})
+        assert await communicator.receive_json_from() == [lock]
+        await communicator.send_json_to({'items': []})
+        assert await communicator.receive_json_from() == [dict(lock, locked=False)]
+        assert not await ItemLock.objects.filter(locked=True).aexists()
+
+        await communicator.disconnect()
+
+    async def test_disconnect_keeps_other_connection_locks(self):
+        communicator_first = websocket_connect_to_asgi(application, self.USERS['alice'])
+        connected, _subprotocol = await communicator_first.connect()
+        self.assertTrue(connected)
+        communicator_second = websocket_connect_to_asgi(application, self.USERS['alice'])
+        connected, _subprotocol = await communicator_second.connect()
+        self.assertTrue(connected)
+        # item 3 and 4 are FOO
+        await communicator_first.send_json_to({'items': [3]})
+        await communicator_first.receive_json_from()
+        await communicator_second.receive_json_from()
+        await communicator_second.send_json_to({'items': [4]})
+        await communicator_first.receive_json_from()
+        await communicator_second.receive_json_from()
+        # only the locks of the closed connection are released
+        await communicator_first.disconnect()
+        assert await communicator_second.receive_json_from() == [{
+            'user': self.USERS['alice'].id,
+            'item': 3,
+            'locked': False
+        }]
+        assert [lock.item_id async for lock in ItemLock.objects.filter(locked=True)] == [4]
+
+        await communicator_second.disconnect()
+
 class TestLocksInTransaction(TransactionTestCase):
     fixtures = ['initial_setup']
 
@@ -1,5 +1,9 @@
+from contextlib import asynccontextmanager
+from asgiref.sync import sync_to_async
 from channels.testing import WebsocketCommunicator
 from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from ..consumers import ItemLockConsumer
 
 User = get_user_model()
@@ -9,3 +13,19 @@ def websocket_connect_to_asgi(application, user, url='/test', **kwargs):
     communicator = WebsocketCommunicator(application, url, **kwargs)
     communicator.scope['user'] = user
     return communicator
+
+
+@asynccontextmanager
+async def capture_queries():
+    """
+    Async version of CaptureQueriesContext, yields the list of queries
+    executed through thread-sensitive sync_to_async once the block exits.
+    """
+    context = CaptureQueriesContext(connection)
+    queries = []
+    await sync_to_async(context.__enter__)()
+    try:
+        yield queries
+    finally:
+        await sync_to_async(context.__exit__)(None, None, None)
+        queries.extend(await sync_to_async(lambda: context.captured_queries)())
@@ -1,3 +1,17 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseForbidden
+from .metrics import metrics
 
-# Create your views here.
+
+def metrics_view(request):
+    """
+    Metrics of lock sockets of this process, in Prometheus text format
+
+    They count users and locks, so only staff and addresses in ``WS_LOCK_METRICS_ALLOWED_IPS`` may read them.
+    """
+    if not metrics.enabled:
+        raise Http404
+    allowed_ips = getattr(settings, 'WS_LOCK_METRICS_ALLOWED_IPS', ['127.0.0.1', '::1'])
+    if not request.user.is_staff and request.META.get('REMOTE_ADDR') not in allowed_ips:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.export(), content_type='text/plain; version=0.0.4; charset=utf-8')
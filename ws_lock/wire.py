@@ -0,0 +1,119 @@
+"""
+Encodings of lock updates sent to clients. JSON is used unless the client
+offers the subprotocol of another format when connecting.
+"""
+import struct
+
+
+class JSONFormat:
+    subprotocol = None
+    binary = False
+    sequenced = False
+
+
+class SequencedJSONFormat:
+    """
+    JSON object `{"epoch", "seq", "snapshot", "locks"}` where `seq` maps item types
+    to the sequence of the update, see ws_lock.events.EventLog.
+    """
+    subprotocol = 'ws_lock.seq.v1'
+    binary = False
+    sequenced = True
+
+    @staticmethod
+    def encode(locks, epoch, seqs, snapshot=False):
+        return {
+            'epoch': epoch,
+            'seq': {str(item_type): seq for item_type, seq in seqs.items()},
+            'snapshot': snapshot,
+            'locks': locks,
+        }
+
+
+class PackedFormat:
+    """
+    Binary frame, all integers are unsigned 32 bits little-endian:
+
+    * number of locks `n`;
+    * `n` item ids;
+    * `n` user ids;
+    * `ceil(n / 8)` bytes of locked flags, flag of lock `i` is bit `i % 8` of byte `i // 8`.
+    """
+    subprotocol = 'ws_lock.packed.v1'
+    binary = True
+    sequenced = False
+
+    @staticmethod
+    def encode(locks):
+        count = len(locks)
+        bitmap = bytearray((count + 7) // 8)
+        for n, lock in enumerate(locks):
+            if lock['locked']:
+                bitmap[n // 8] |= 1 << (n % 8)
+        return struct.pack(
+            f'<I{count}I{count}I',
+            count,
+            *(lock['item'] for lock in locks),
+            *(lock['user'] for lock in locks),
+        ) + bytes(bitmap)
+
+    @staticmethod
+    def decode(data):
+        (count,) = struct.unpack_from('<I', data)
+        ids = struct.unpack_from(f'<{2 * count}I', data, 4)
+        bitmap = data[4 + 8 * count:]
+        return [
+            {'item': ids[n], 'user': ids[count + n], 'locked': bool(bitmap[n // 8] & (1 << (n % 8)))}
+            for n in range(count)
+        ]
+
+
+class SequencedPackedFormat:
+    """
+    Same as SequencedJSONFormat, as a binary frame made of:
+
+    * epoch, unsigned 32 bits little-endian;
+    * flags byte, bit 0 is set for snapshots;
+    * number of item types `t`, unsigned 16 bits;
+    * `t` pairs of item type (unsigned 16 bits) and sequence (unsigned 32 bits);
+    * locks as a PackedFormat frame.
+    """
+    subprotocol = 'ws_lock.packed.seq.v1'
+    binary = True
+    sequenced = True
+
+    @staticmethod
+    def encode(locks, epoch, seqs, snapshot=False):
+        header = struct.pack(
+            f'<IBH{"HI" * len(seqs)}',
+            epoch,
+            int(snapshot),
+            len(seqs),
+            *(value for item in sorted(seqs.items()) for value in item),
+        )
+        return header + PackedFormat.encode(locks)
+
+    @staticmethod
+    def decode(data):
+        epoch, flags, count = struct.unpack_from('<IBH', data)
+        values = struct.unpack_from(f'<{"HI" * count}', data, 7)
+        return {
+            'epoch': epoch,
+            'seq': dict(zip(values[::2], values[1::2])),
+            'snapshot': bool(flags & 1),
+            'locks': PackedFormat.decode(data[7 + 6 * count:]),
+        }
+
+
+FORMATS = {
+    wire_format.subprotocol: wire_format
+    for wire_format in (PackedFormat, SequencedJSONFormat, SequencedPackedFormat)
+}
+
+
+def negotiate(subprotocols, offered):
+    """First format requested by the client among the offered ones, JSON otherwise"""
+    for subprotocol in subprotocols:
+        if subprotocol in offered and subprotocol in FORMATS:
+            return FORMATS[subprotocol]
+    return JSONFormat